@@ -0,0 +1,488 @@
+#!/usr/bin/env python3
+"""
+Aggregation of accident data
+Author: Karel Norek, xnorek01
+"""
+# -*- coding: utf-8 -*-
+import numpy as np
+import pandas as pd
+import collections
+import hashlib
+import os
+import weakref
+
+# Nejvetsi rozsah celych cisel, pro ktery se kody pocitaji tabulkou misto razeni
+MAX_RANGE = 1 << 16
+
+
+def factorize(values, domain=None):
+    """
+    Convert values to codes 0..n-1
+
+    Small integer columns are coded with lookup table, other columns
+    with sorting.
+
+    Arguments:
+        values  Numpy array with values
+        domain  Values which get codes in given order (default all values
+                present, sorted), values outside of domain get code -1
+
+    Return:
+        Tuple (domain, codes)
+    """
+    values = np.asarray(values)
+    integer = values.dtype.kind in 'iub'
+    small = integer and (len(values) == 0 or int(values.max()) - int(values.min()) <= MAX_RANGE)
+
+    if domain is None:
+        if not small or len(values) == 0:
+            return np.unique(values, return_inverse=True)
+        low = int(values.min())
+        # Rozdil se pocita v int64, v int8 by pretekl
+        domain = (np.flatnonzero(np.bincount(values.astype(np.int64) - low)) + low).astype(values.dtype)
+    domain = np.asarray(domain)
+
+    if small and domain.dtype.kind in 'iub':
+        low = min(int(values.min()), int(domain.min())) if len(values) != 0 else int(domain.min())
+        high = max(int(values.max()), int(domain.max())) if len(values) != 0 else int(domain.max())
+        table = np.full(high - low + 1, -1, dtype=np.intp)
+        table[domain.astype(np.int64) - low] = np.arange(len(domain))
+        return domain, table[values.astype(np.int64) - low]
+
+    order = np.argsort(domain)
+    position = np.searchsorted(domain, values, sorter=order).clip(0, max(len(domain) - 1, 0))
+    if len(domain) == 0:
+        return domain, np.full(len(values), -1, dtype=np.intp)
+    found = domain[order][position] == values
+    return domain, np.where(found, order[position], -1)
+
+
+def crosstab(first, second, first_domain=None, second_domain=None):
+    """
+    Count rows for every pair of values of two coded columns with one bincount
+
+    Arguments:
+        first, second   Numpy arrays of same length
+        first_domain    Values of first column to count, see factorize
+        second_domain   Values of second column to count, see factorize
+
+    Return:
+        Tuple (first_domain, second_domain, counts), counts[i, j] is number of
+        rows with first_domain[i] and second_domain[j]
+    """
+    first_domain, first_codes = factorize(first, first_domain)
+    second_domain, second_codes = factorize(second, second_domain)
+
+    key = first_codes * len(second_domain) + second_codes
+    if (first_codes < 0).any() or (second_codes < 0).any():
+        key = key[(first_codes >= 0) & (second_codes >= 0)]
+
+    size = len(first_domain) * len(second_domain)
+    counts = np.bincount(key, minlength=size).reshape(len(first_domain), len(second_domain))
+    return first_domain, second_domain, counts
+
+
+def count_by(df, keys, mask=None, name='count'):
+    """
+    Count rows for every observed combination of keys without temporary columns
+
+    Keys are converted to codes (categorical codes, lookup table for small
+    integers, pd.factorize otherwise) and counted with one bincount of
+    combined codes, like groupby(..., observed=True).size().
+
+    Arguments:
+        df      DataFrame with data
+        keys    List of column names or named Series aligned with df
+        mask    Boolean array of rows to count (default all rows)
+        name    Name of column with counts
+
+    Return:
+        DataFrame with key columns and column name, one row for every
+        combination present in counted rows, sorted by keys
+    """
+    series = [df[key] if isinstance(key, str) else key for key in keys]
+    names = [values.name for values in series]
+    if mask is not None:
+        mask = np.asarray(mask, dtype=bool)
+
+    domains = []
+    codes = []
+    for values in series:
+        if isinstance(values.dtype, pd.CategoricalDtype):
+            domain, value_codes = values.cat.categories, values.cat.codes.to_numpy()
+            value_codes = value_codes if mask is None else value_codes[mask]
+        else:
+            values = values.to_numpy() if mask is None else values.to_numpy()[mask]
+            if values.dtype.kind in 'iub':
+                domain, value_codes = factorize(values)
+            else:
+                value_codes, domain = pd.factorize(values, sort=True)
+        domains.append(pd.Index(domain))
+        codes.append(value_codes)
+
+    key = np.zeros(len(codes[0]) if codes else 0, dtype=np.int64)
+    valid = np.ones(len(key), dtype=bool)
+    for domain, value_codes in zip(domains, codes):
+        key = key * len(domain) + value_codes
+        valid &= value_codes >= 0
+    shape = [len(domain) for domain in domains]
+    counts = np.bincount(key[valid] if not valid.all() else key, minlength=int(np.prod(shape)))
+
+    present = np.flatnonzero(counts)
+    positions = np.unravel_index(present, shape)
+    columns = {column: domain[position] for column, domain, position in zip(names, domains, positions)}
+    columns[name] = counts[present]
+    return pd.DataFrame(columns)
+
+
+def count_chunks(chunks, keys, name='count'):
+    """
+    Count rows for every observed combination of keys over chunks of data
+
+    Every chunk is counted with count_by and partial counts are merged,
+    so only one chunk and the counts are in memory at a time.
+
+    Arguments:
+        chunks  Iterable of dictionaries column : numpy array (e.g.
+                DataDownloader.iter_chunks) or DataFrames
+        keys    List of column names
+        name    Name of column with counts
+
+    Return:
+        DataFrame like count_by
+    """
+    total = None
+    for chunk in chunks:
+        partial = count_by(pd.DataFrame({key: chunk[key] for key in keys}), keys, name=name)
+        partial = partial.set_index(keys)[name]
+        total = partial if total is None else total.add(partial, fill_value=0)
+
+    if total is None:
+        return pd.DataFrame({column: [] for column in keys + [name]}).astype({name: np.int64})
+    return total.astype(np.int64).sort_index().rename(name).reset_index()
+
+
+# Pohledy krychle: nazev : sloupce, jejichz kombinace se pocitaji pro kraj a den
+CUBE_VIEWS = {
+    'p21': ('p21',),
+    'p18': ('p18',),
+    'p58_p10': ('p58', 'p10'),
+}
+
+# Nejvetsi pocet ulozenych krychli, nejdele nepouzite se mazou
+MAX_CUBES = 8
+
+_cubes = collections.OrderedDict()
+
+
+class AggregateCube:
+    """
+    Precomputed counts of accidents for region x day x values of coded columns
+
+    Attributes:
+        regions     Numpy array with names of regions (first axis)
+        start       First day (datetime64[D]), second axis is offset from it
+        days        Number of days
+        domains     Dictionary column : values of column (further axes)
+        views       Dictionary view : tuple of columns
+        counts      Dictionary view : numpy array region x day x values
+    """
+
+    def __init__(self, regions, start, days, domains, views, counts):
+        """
+        Initialize cube
+
+        Arguments:
+            regions, start, days, domains, views, counts    See attributes
+        """
+        self.regions = regions
+        self.start = start
+        self.days = days
+        self.domains = domains
+        self.views = views
+        self.counts = counts
+
+    @classmethod
+    def build(cls, df, views=None):
+        """
+        Build cube with one pass of bincount per view
+
+        Arguments:
+            df      DataFrame with region, date (or p2a) and columns of views
+            views   Dictionary view : tuple of columns (default CUBE_VIEWS)
+
+        Return:
+            AggregateCube
+        """
+        if views is None:
+            views = CUBE_VIEWS
+        dates = (df['date'] if 'date' in df else df['p2a']).to_numpy().astype('datetime64[D]')
+        regions, region_codes = factorize(df['region'].to_numpy().astype(str))
+        start = dates.min() if len(dates) != 0 else np.datetime64('1970-01-01')
+        days = int((dates.max() - start).astype(np.int64)) + 1 if len(dates) != 0 else 0
+        day_codes = (dates - start).astype(np.int64)
+
+        domains = {}
+        codes = {}
+        for columns in views.values():
+            for column in columns:
+                if column not in domains:
+                    domains[column], codes[column] = factorize(np.asarray(df[column].to_numpy()))
+
+        counts = {}
+        for view, columns in views.items():
+            key = region_codes * days + day_codes
+            shape = [len(regions), days]
+            for column in columns:
+                key = key * len(domains[column]) + codes[column]
+                shape.append(len(domains[column]))
+            counts[view] = np.bincount(key, minlength=int(np.prod(shape))).astype(np.int32).reshape(shape)
+
+        return cls(regions, start, days, domains, dict(views), counts)
+
+    def save(self, path):
+        """
+        Save cube to .npz file
+
+        Arguments:
+            path    Path to file
+        """
+        arrays = {'regions': self.regions, 'start': np.array(self.start), 'days': np.array(self.days),
+                  'views': np.array([f"{view}:{','.join(columns)}" for view, columns in self.views.items()])}
+        for column, domain in self.domains.items():
+            arrays[f"domain_{column}"] = domain
+        for view, counts in self.counts.items():
+            arrays[f"counts_{view}"] = counts
+        np.savez(path, **arrays)
+
+    @classmethod
+    def load(cls, path):
+        """
+        Load cube from .npz file
+
+        Arguments:
+            path    Path to file
+
+        Return:
+            AggregateCube
+        """
+        with np.load(path) as data:
+            views = {}
+            for item in data['views']:
+                view, columns = str(item).split(':')
+                views[view] = tuple(columns.split(','))
+            domains = {column: data[f"domain_{column}"] for columns in views.values() for column in columns}
+            counts = {view: data[f"counts_{view}"] for view in views}
+            return cls(data['regions'], data['start'][()], int(data['days']), domains, views, counts)
+
+    def select(self, view, regions=None, start=None, end=None):
+        """
+        Get counts of view for regions and inclusive date range
+
+        Arguments:
+            view    Name of view
+            regions List of regions (default all in cube, missing have zeros)
+            start   First day (string or datetime64, default first day of cube)
+            end     Last day (string or datetime64, default last day of cube)
+
+        Return:
+            Tuple (regions, dates, counts), counts have axes region x day x values
+        """
+        counts = self.counts[view]
+        first = 0 if start is None else int((np.datetime64(start, 'D') - self.start).astype(np.int64))
+        last = self.days if end is None else int((np.datetime64(end, 'D') - self.start).astype(np.int64)) + 1
+        first, last = min(max(first, 0), self.days), min(max(last, 0), self.days)
+        counts = counts[:, first:last]
+        dates = self.start + np.arange(first, last)
+
+        if regions is None:
+            return self.regions, dates, counts
+        regions = np.asarray(regions)
+        index = np.array([np.flatnonzero(self.regions == region)[0] if region in self.regions else -1
+                          for region in regions], dtype=np.intp)
+        result = np.zeros((len(regions),) + counts.shape[1:], dtype=counts.dtype)
+        result[index >= 0] = counts[index[index >= 0]]
+        return regions, dates, result
+
+
+def content_key(df, columns):
+    """
+    Get hash identifying content of columns of dataframe
+
+    Arguments:
+        df      DataFrame with data
+        columns List of column names
+
+    Return:
+        Hex digest
+    """
+    digest = hashlib.sha1(str(len(df)).encode())
+    for column in columns:
+        digest.update(column.encode())
+        digest.update(pd.util.hash_pandas_object(df[column], index=False).to_numpy().tobytes())
+    return digest.hexdigest()
+
+
+def prune_cubes(folder, keep=MAX_CUBES):
+    """
+    Remove least recently used cube files from folder
+
+    Arguments:
+        folder  Folder where cubes are stored
+        keep    Number of cubes which are kept
+    """
+    paths = [os.path.join(folder, name) for name in os.listdir(folder)
+             if name.startswith('cube_') and name.endswith('.npz') and '.tmp' not in name]
+    paths.sort(key=os.path.getmtime, reverse=True)
+    for path in paths[keep:]:
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+
+
+def get_cube(df, folder='data', views=None):
+    """
+    Get aggregate cube of dataframe, built only once for the same data
+
+    Cube is identified by content of columns it is built from (content_key),
+    so filtered subsets and modified dataframes get their own cube. Only
+    MAX_CUBES most recently used cubes are kept in memory and persisted in
+    folder.
+
+    Arguments:
+        df      DataFrame with data
+        folder  Folder where cubes are stored
+        views   Dictionary view : tuple of columns (default CUBE_VIEWS)
+
+    Return:
+        AggregateCube
+    """
+    if views is None:
+        views = CUBE_VIEWS
+    columns = ['region', 'date' if 'date' in df else 'p2a']
+    columns += sorted({column for view in views.values() for column in view} - set(columns))
+    name = hashlib.sha1(repr((content_key(df, columns), sorted(views.items()))).encode()).hexdigest()
+    if name in _cubes:
+        _cubes.move_to_end(name)
+        return _cubes[name]
+
+    path = f"./{folder}/cube_{name}.npz"
+    if os.path.exists(path):
+        cube = AggregateCube.load(path)
+        os.utime(path)
+    else:
+        cube = AggregateCube.build(df, views)
+        if os.path.isdir(folder):
+            cube.save(path + '.tmp.npz')
+            os.replace(path + '.tmp.npz', path)
+            prune_cubes(folder)
+    _cubes[name] = cube
+    while len(_cubes) > MAX_CUBES:
+        _cubes.popitem(last=False)
+    return cube
+
+
+class DateIndex:
+    """
+    Rows of dataframe sorted by date, range queries are binary searches
+
+    Attributes:
+        dates   Sorted dates (datetime64[ns]), missing dates at the end
+        valid   Number of rows with date
+        order   Positions of rows in order of dates, None if rows are
+                already sorted
+    """
+
+    def __init__(self, dates):
+        """
+        Sort dates
+
+        Arguments:
+            dates   Array with dates of rows
+        """
+        dates = np.asarray(pd.to_datetime(dates), dtype='datetime64[ns]')
+        if np.isnat(dates).any() or (dates[1:] < dates[:-1]).any():
+            self.order = np.argsort(dates, kind='stable')
+            self.dates = dates[self.order]
+        else:
+            self.order = None
+            self.dates = dates
+        self.valid = len(dates) - np.count_nonzero(np.isnat(dates))
+
+    def bounds(self, start=None, end=None):
+        """
+        Get positions of inclusive date range in sorted dates
+
+        Arguments:
+            start   First date (default no lower bound)
+            end     Last date (default no upper bound)
+
+        Return:
+            Tuple (first, last), range is dates[first:last]
+        """
+        dates = self.dates[:self.valid]
+        first = 0 if start is None else np.searchsorted(dates, pd.Timestamp(start).to_datetime64(), 'left')
+        last = self.valid if end is None else np.searchsorted(dates, pd.Timestamp(end).to_datetime64(), 'right')
+        return int(first), int(max(first, last))
+
+    def rows(self, start=None, end=None):
+        """
+        Get rows with date in inclusive range
+
+        Arguments:
+            start   First date (default no lower bound)
+            end     Last date (default no upper bound)
+
+        Return:
+            Slice if rows are sorted by date, otherwise sorted array of
+            positions (rows keep their original order)
+        """
+        first, last = self.bounds(start, end)
+        if self.order is None:
+            return slice(first, last)
+        return np.sort(self.order[first:last])
+
+
+_date_indexes = {}
+
+
+def get_date_index(df, column='date'):
+    """
+    Get date index of dataframe column, built only once per dataframe
+
+    Index is kept while dataframe exists, dataframe must not be modified
+    in place after index was built.
+
+    Arguments:
+        df      DataFrame with data
+        column  Column with dates
+
+    Return:
+        DateIndex
+    """
+    key = (id(df), column)
+    if key in _date_indexes:
+        reference, index = _date_indexes[key]
+        if reference() is df and len(index.dates) == len(df):
+            return index
+
+    index = DateIndex(df[column])
+    _date_indexes[key] = (weakref.ref(df, lambda _: _date_indexes.pop(key, None)), index)
+    return index
+
+
+def select_dates(df, start=None, end=None, column='date'):
+    """
+    Get rows of dataframe with date in inclusive range using date index
+
+    Arguments:
+        df      DataFrame with data
+        start   First date (default no lower bound)
+        end     Last date (default no upper bound)
+        column  Column with dates
+
+    Return:
+        DataFrame with selected rows
+    """
+    return df.iloc[get_date_index(df, column).rows(start, end)]
@@ -6,6 +6,10 @@ import pandas as pd
 import seaborn as sns
 import numpy as np
 import os
+import sys
+
+from download import DataDownloader
+from aggregate import get_cube
 
 # muzete pridat libovolnou zakladni knihovnu ci knihovnu
 # predstavenou na prednaskach dalsi knihovny pak na dotaz
@@ -71,7 +75,33 @@ def get_dataframe(filename: str, verbose: bool = False) -> pd.DataFrame:
     Return:
         Function return converted dataframe
     """
-    df = pd.read_pickle(filename)
+    return convert_dataframe(read_dataframe(filename), verbose)
+
+
+def read_dataframe(filename: str) -> pd.DataFrame:
+    """
+    Read dataframe from file without conversion
+
+    Arguments:
+        filename - name of file with data
+
+    Return:
+        Function return dataframe
+    """
+    return pd.read_pickle(filename)
+
+
+def convert_dataframe(df: pd.DataFrame, verbose: bool = False) -> pd.DataFrame:
+    """
+    Convert types of loaded dataframe to category with some exeptions
+
+    Arguments:
+        df - dataframe with data, it is converted in place
+        verbose - print size of data in MB before and after type conversion
+
+    Return:
+        Function return converted dataframe
+    """
     if verbose:
         print(f"orig_size={df.memory_usage(deep=True).sum() / 1048576:.1f} MB")
 
@@ -92,6 +122,71 @@ def get_dataframe(filename: str, verbose: bool = False) -> pd.DataFrame:
     return df
 
 
+def get_dataframe_from_downloader(downloader: DataDownloader = None,
+                                  regions: list = None,
+                                  verbose: bool = False) -> pd.DataFrame:
+    """
+    Build already converted dataframe directly from DataDownloader data
+
+    Columns are created from stored types without object intermediate:
+    dictionary encoded columns become categories from their codes, integers
+    and floats are downcasted and date is datetime copy of p2a.
+
+    Arguments:
+        downloader - DataDownloader with data (default DataDownloader())
+        regions - regions to load (default all)
+        verbose - print size of data in MB before and after type conversion,
+            there is no unconverted dataframe to measure, so size before is
+            computed for dataframe with int64, float64 and object columns
+
+    Return:
+        Function return converted dataframe
+    """
+    if downloader is None:
+        downloader = DataDownloader()
+    data = downloader.get_dict(regions, decode=False)
+    rows = len(data['region'])
+
+    columns = {}
+    # Velikost dataframe s object sloupci se jen spocita, takovy se nevytvari
+    orig_size = 128
+    for column, values in data.items():
+        encoding = downloader.column_encoding(column, values.dtype)
+        if encoding is None and values.dtype.kind not in 'U':
+            orig_size += 8 * rows
+            if values.dtype.kind == 'i':
+                columns[column] = pd.to_numeric(values, downcast='signed')
+            elif values.dtype.kind == 'f':
+                columns[column] = pd.to_numeric(values, downcast='float')
+            else:
+                columns[column] = values
+            continue
+
+        if encoding == 'category':
+            categories = downloader.categories(column)
+            codes = values
+        else:
+            categories, codes = np.unique(values, return_inverse=True)
+            categories = categories.astype(str)
+        counts = np.bincount(codes, minlength=len(categories))
+        orig_size += 8 * rows + int(np.dot(counts, [sys.getsizeof(str(c)) for c in categories]))
+
+        if column == 'region':
+            columns[column] = categories[codes]
+        else:
+            columns[column] = pd.Categorical.from_codes(
+                codes, categories).remove_unused_categories()
+
+    columns['date'] = columns['p2a'].copy()
+    df = pd.DataFrame(columns)
+
+    if verbose:
+        print(f"orig_size={orig_size / 1048576:.1f} MB (computed)")
+        print(f"new_size={df.memory_usage(deep=True).sum() / 1048576:.1f} MB")
+
+    return df
+
+
 # Ukol 2: počty nehod v jednotlivých regionech podle druhu silnic
 def plot_roadtype(df: pd.DataFrame, fig_location: str = None,
                   show_figure: bool = False):
@@ -103,9 +198,14 @@ def plot_roadtype(df: pd.DataFrame, fig_location: str = None,
         fig_location - if specified, store graph in given location
         show_figure - show figure if True
     """
-    df_type = df[df['region'].isin(
-                regions)][['region', 'p21']]
-    df_type['tmp'] = 1
+    cube = get_cube(df)
+    _, _, counts = cube.select('p21', regions)
+    counts = counts.sum(axis=1)
+    region_index, value_index = np.nonzero(counts)
+    df_type = pd.DataFrame({
+        'region': np.asarray(regions)[region_index],
+        'p21': cube.domains['p21'][value_index],
+        'count': counts[region_index, value_index]})
     df_type.loc[df_type['p21'] == 4, 'p21'] = 3
     df_type = df_type.groupby(['region', 'p21']).agg('sum').reset_index()
     df_type = df_type.sort_values(by=['p21'])
@@ -114,7 +214,7 @@ def plot_roadtype(df: pd.DataFrame, fig_location: str = None,
     sns.set_style("darkgrid")
     sns.set_palette("rocket")
 
-    g = sns.catplot(x="region", y="tmp", data=df_type, col="p21", kind="bar",
+    g = sns.catplot(x="region", y="count", data=df_type, col="p21", kind="bar",
                     col_wrap=3, height=3.5, aspect=1, ci=None, sharex=False,
                     sharey=False, order=regions)
     (g.set_titles("{col_name}")
@@ -147,21 +247,24 @@ def plot_animals(df: pd.DataFrame, fig_location: str = None,
         fig_location - if specified, store graph in given location
         show_figure - show figure if True
     """
-    df_animals = df[df['p58'] == 5]
-    df_animals = df_animals[df_animals['region'].isin(
-                    regions)][['region', 'p10', 'date']]
-    df_animals = df_animals[
-                (df_animals['date'] >= pd.to_datetime('2016-1-1'))
-                & (df_animals['date'] <= pd.to_datetime('2020-12-31'))]
-
-    df_animals['p10'] = df_animals['p10'].map(fault)
-    df_animals['date'] = df_animals['date'].dt.month
-    df_animals['tmp'] = 1
+    cube = get_cube(df)
+    _, dates, counts = cube.select('p58_p10', regions, '2016-01-01', '2020-12-31')
+    counts = counts[:, :, cube.domains['p58'] == 5].sum(axis=2)
+
+    months = dates.astype('datetime64[M]').astype(np.int64) % 12 + 1
+    monthly = np.stack([counts[:, months == month].sum(axis=1)
+                        for month in range(1, 13)], axis=1)
+    region_index, month_index, value_index = np.nonzero(monthly)
+    df_animals = pd.DataFrame({
+        'region': np.asarray(regions)[region_index],
+        'date': month_index + 1,
+        'p10': pd.Series(cube.domains['p10'][value_index]).map(fault),
+        'count': monthly[region_index, month_index, value_index]})
     df_animals = df_animals.groupby(
                 ['region', 'date', 'p10']).agg('sum').reset_index()
 
     sns.set_palette(["#52006A", "#FF7600", "#CD113B"])
-    g = sns.catplot(x="date", y='tmp', data=df_animals, col="region",
+    g = sns.catplot(x="date", y='count', data=df_animals, col="region",
                     kind="bar", col_wrap=2, height=3, aspect=1.5,
                     ci=None, hue="p10", sharex=False, sharey=False)
     (g.set_titles("Kraj: {col_name}")
@@ -188,22 +291,34 @@ def plot_conditions(df: pd.DataFrame, fig_location: str = None,
         fig_location - if specified, store graph in given location
         show_figure - show figure if True
     """
-    df_w = df[df['region'].isin(
-            regions)][['region', 'p18', 'date']]
-    df_w = df_w[
-            (df_w['date'] >= pd.to_datetime('2016-1-1'))
-            & (df_w['date'] <= pd.to_datetime('2020-12-31'))]
-
-    df_w = df_w[df_w['p18'] != 0]
-    df_w['p18'] = df_w['p18'].map(weather)
-    df_w['tmp'] = 1
-    df_w = df_w.pivot_table(columns='p18', values='tmp', aggfunc='sum',
-                            index=['date', 'region']).reset_index()
-    df_w = df_w.fillna(0)
-    df_w = (df_w.groupby(['region']).resample('M', on='date').sum().
-            reset_index())
-    df_w = df_w.melt(id_vars=["region", 'date'],
-                     var_name="p18", value_name="value")
+    cube = get_cube(df)
+    _, dates, counts = cube.select('p18', regions, '2016-01-01', '2020-12-31')
+    domain = cube.domains['p18']
+    keep = np.isin(domain, list(weather.keys()))
+    counts = counts[:, :, keep]
+    labels = [weather[value] for value in domain[keep]]
+
+    # Soucty po mesicich, krychle ma vsechny dny za sebou
+    months = dates.astype('datetime64[M]')
+    bounds = np.flatnonzero(np.r_[True, months[1:] != months[:-1]]) if len(months) != 0 else []
+    monthly = np.add.reduceat(counts, bounds, axis=1) if len(months) != 0 else counts
+    month_ends = (months[bounds] + 1).astype('datetime64[D]') - 1 if len(months) != 0 else months
+    present = monthly.sum(axis=(0, 1)) > 0
+
+    frames = []
+    for index, region in enumerate(regions):
+        active = np.flatnonzero(monthly[index].sum(axis=1) > 0)
+        if len(active) == 0:
+            continue
+        span = slice(active[0], active[-1] + 1)
+        for label in sorted(np.asarray(labels)[present]):
+            frames.append(pd.DataFrame({
+                'region': region,
+                'date': pd.to_datetime(month_ends[span]),
+                'p18': label,
+                'value': monthly[index, span][:, labels.index(label)].astype(np.float64)}))
+    df_w = pd.concat(frames, ignore_index=True) if frames != [] else pd.DataFrame(
+        columns=['region', 'date', 'p18', 'value'])
 
     sns.set_palette("bright")
     g = sns.relplot(data=df_w, kind="line", x="date", y='value', hue='p18',
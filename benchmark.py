@@ -0,0 +1,192 @@
+#!/usr/bin/env python3
+"""
+Benchmarks of data processing
+Author: Karel Norek, xnorek01
+"""
+# -*- coding: utf-8 -*-
+import argparse
+import os
+import time
+import tracemalloc
+
+import numpy as np
+
+from download import DataDownloader
+from aggregate import crosstab, count_by
+from analysis import get_dataframe_from_downloader
+
+
+def bench_parse(args):
+    """
+    Measure parsing of all regions with different number of processes
+
+    Arguments:
+        args    Parsed arguments (folder, workers)
+    """
+    downloader = DataDownloader(folder=args.folder, offline=True)
+    regions = list(downloader.regions.keys())
+
+    base = None
+    for workers in args.workers:
+        start = time.perf_counter()
+        downloader.parse_archives(regions, workers)
+        elapsed = time.perf_counter() - start
+        if base is None:
+            base = elapsed
+        print(f"workers={workers:<3} time={elapsed:8.2f} s  speedup={base / elapsed:5.2f}x")
+
+
+def bench_assemble(args):
+    """
+    Measure time and peak allocated memory of get_dict for all regions
+
+    Arguments:
+        args    Parsed arguments (folder)
+    """
+    downloader = DataDownloader(folder=args.folder, offline=True)
+    downloader.get_dict()
+
+    tracemalloc.start()
+    start = time.perf_counter()
+    result = downloader.get_dict()
+    elapsed = time.perf_counter() - start
+    current, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    size = sum(values.nbytes for values in result.values())
+    print(f"time={elapsed:.2f} s  result={size / 1e6:.1f} MB  peak={peak / 1e6:.1f} MB  "
+          f"peak/result={peak / size:.2f}")
+
+
+def loop_counts(data_source):
+    """
+    Count accidents per region and p24 the way plot_stat did before crosstab
+
+    Arguments:
+        data_source     Dictionary from get_dict
+
+    Return:
+        Dictionary region : counts of p24 values 1, 2, 3, 4, 5, 0
+    """
+    reg_dict = {}
+    for region in set(data_source['region']):
+        indx = np.where(data_source['region'] == region)
+        reg_dict[region] = np.array([np.sum(data_source['p24'][indx] == k) for k in [1, 2, 3, 4, 5, 0]])
+    return reg_dict
+
+
+def bench_crosstab(args):
+    """
+    Compare region x p24 counting loop with crosstab
+
+    Arguments:
+        args    Parsed arguments (folder, repeat)
+    """
+    downloader = DataDownloader(folder=args.folder, offline=True)
+    decoded = downloader.get_dict(columns=['region', 'p24'])
+    coded = downloader.get_dict(columns=['region', 'p24'], decode=False)
+    regions = sorted(downloader.regions.keys())
+    region_codes = [list(downloader.regions.keys()).index(region) for region in regions]
+
+    cases = [
+        ('loop (strings)', lambda: loop_counts(decoded)),
+        ('crosstab (strings)', lambda: crosstab(decoded['region'], decoded['p24'], regions, [1, 2, 3, 4, 5, 0])),
+        ('crosstab (codes)', lambda: crosstab(coded['region'], coded['p24'], region_codes, [1, 2, 3, 4, 5, 0])),
+    ]
+    print(f"rows={len(decoded['region'])}")
+    for name, function in cases:
+        start = time.perf_counter()
+        for _ in range(args.repeat):
+            function()
+        elapsed = (time.perf_counter() - start) / args.repeat
+        print(f"{name:<20} {elapsed * 1000:9.2f} ms")
+
+
+def tmp_counts(df, mask, columns):
+    """
+    Count accidents the way doc.py did before count_by, with tmp column
+
+    Arguments:
+        df          DataFrame with data
+        mask        Boolean array of counted rows
+        columns     Grouped columns
+
+    Return:
+        DataFrame with columns and counts in column tmp
+    """
+    df = df[mask]
+    df = df[columns]
+    df['tmp'] = 1
+    return df.groupby(columns).agg('sum').reset_index()
+
+
+def measure(function):
+    """
+    Measure time and peak allocated memory of function
+
+    Arguments:
+        function    Function without arguments
+
+    Return:
+        Tuple (seconds, peak bytes)
+    """
+    tracemalloc.start()
+    start = time.perf_counter()
+    function()
+    elapsed = time.perf_counter() - start
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return elapsed, peak
+
+
+def bench_count(args):
+    """
+    Compare counting with temporary tmp column and count_by
+
+    Arguments:
+        args    Parsed arguments (folder, repeat)
+    """
+    df = get_dataframe_from_downloader(DataDownloader(folder=args.folder, offline=True))
+    police = (df['p48a'] == 12).to_numpy()
+    everything = np.ones(len(df), dtype=bool)
+
+    cases = [
+        ('region, p48a == 12', police, ['region']),
+        ('region x p21', everything, ['region', 'p21']),
+        ('region x p2a', everything, ['region', 'p2a']),
+    ]
+    print(f"rows={len(df)}  police={np.count_nonzero(police)}")
+    for name, mask, columns in cases:
+        for method, function in [('tmp', lambda: tmp_counts(df, mask, columns)),
+                                 ('count_by', lambda: count_by(df, columns, mask))]:
+            function()
+            elapsed = min(measure(function)[0] for _ in range(args.repeat))
+            _, peak = measure(function)
+            print(f"{name:<20} {method:<10} {elapsed * 1000:9.2f} ms  peak={peak / 1e6:7.2f} MB")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--folder', type=str, default='data')
+    subparsers = parser.add_subparsers(dest='benchmark', required=True)
+
+    parse = subparsers.add_parser('parse', help='parallel parsing of archives')
+    parse.add_argument('--workers', type=int, nargs='+', default=[1, 2, 4, 7, 14],
+                       help='numbers of processes to compare')
+    parse.set_defaults(func=bench_parse)
+
+    assemble = subparsers.add_parser('assemble', help='memory used by get_dict')
+    assemble.set_defaults(func=bench_assemble)
+
+    cross = subparsers.add_parser('crosstab', help='region x p24 counts in plot_stat')
+    cross.add_argument('--repeat', type=int, default=10)
+    cross.set_defaults(func=bench_crosstab)
+
+    count = subparsers.add_parser('count', help='counting in doc.py with and without tmp column')
+    count.add_argument('--repeat', type=int, default=10)
+    count.set_defaults(func=bench_count)
+
+    args = parser.parse_args()
+    if not os.path.isdir(args.folder):
+        parser.error(f"folder {args.folder} with downloaded archives does not exist")
+    args.func(args)
@@ -0,0 +1,286 @@
+#!/usr/bin/env python3
+"""
+Clustering of projected accident coordinates
+Author: Karel Norek, xnorek01
+"""
+# -*- coding: utf-8 -*-
+import collections
+import hashlib
+import json
+import os
+
+import numpy as np
+import sklearn.cluster
+
+# Pocet bodu zpracovanych najednou pri uceni a prirazovani
+CHUNK = 1 << 16
+# Verze enginu v klici ulozenych prirazeni, po zmene enginu se spocitaji znovu
+VERSION = 3
+# Nejvetsi pocet ulozenych prirazeni, nejdele nepouzite se mazou
+MAX_LABELS = 256
+
+_labels = collections.OrderedDict()
+
+
+def kmeans_labels(coords, n_clusters=25, batch_size=4096, seed=0, passes=3):
+    """
+    Seeded mini-batch k-means (sklearn MiniBatchKMeans)
+
+    At most CHUNK points are fitted at once with fit, more points are fitted
+    with partial_fit by mini-batches of batch_size points in several passes,
+    every pass in another seeded random order. Points are labelled by chunks,
+    so only one chunk of points is copied at a time.
+
+    Arguments:
+        coords      Numpy array n x 2
+        n_clusters  Number of clusters
+        batch_size  Number of points in mini-batch
+        seed        Seed of random generator (random_state)
+        passes      Number of passes over points fitted by mini-batches
+
+    Return:
+        Numpy array of labels
+    """
+    if len(coords) == 0:
+        return np.zeros(0, dtype=np.int32)
+    n_clusters = min(n_clusters, len(coords))
+    model = sklearn.cluster.MiniBatchKMeans(n_clusters=n_clusters, batch_size=batch_size, random_state=seed)
+
+    if len(coords) <= CHUNK:
+        model.fit(coords)
+    else:
+        # Prvni davka musi mit aspon n_clusters bodu, posledni kratka se pripoji k predchozi
+        batch = max(batch_size, n_clusters)
+        starts = list(range(0, len(coords), batch))
+        if len(coords) - starts[-1] < n_clusters:
+            starts.pop()
+        rng = np.random.default_rng(seed)
+        for _ in range(passes):
+            order = rng.permutation(len(coords))
+            for start, end in zip(starts, starts[1:] + [len(coords)]):
+                model.partial_fit(coords[order[start:end]])
+
+    labels = np.empty(len(coords), dtype=np.int32)
+    for start in range(0, len(coords), CHUNK):
+        labels[start:start + CHUNK] = model.predict(coords[start:start + CHUNK])
+    return labels
+
+
+def grid_cells(coords, size):
+    """
+    Get square grid cell of every point
+
+    Arguments:
+        coords      Numpy array n x 2
+        size        Size of cell in metres
+
+    Return:
+        Numpy array n x 2 of integer cell coordinates
+    """
+    return np.floor(coords / size).astype(np.int64)
+
+
+def cell_keys(cells, margin=0):
+    """
+    Convert integer cell coordinates to one integer key per cell
+
+    Arguments:
+        cells       Numpy array n x 2 of integer cell coordinates
+        margin      Number of empty cells around data, neighbours of cells
+                    within margin have valid keys too
+
+    Return:
+        Tuple (keys, width), key is (cx - low_x) * width + (cy - low_y)
+    """
+    if len(cells) == 0:
+        return np.zeros(0, dtype=np.int64), 1
+    low = cells.min(axis=0) - margin
+    width = int(cells[:, 1].max() - low[1]) + 1 + margin
+    return (cells[:, 0] - low[0]) * width + (cells[:, 1] - low[1]), width
+
+
+def grid_labels(coords, size=2000.0):
+    """
+    Label points by square grid cell
+
+    Arguments:
+        coords      Numpy array n x 2
+        size        Size of cell in metres
+
+    Return:
+        Numpy array of labels (cells in sorted order)
+    """
+    keys = cell_keys(grid_cells(coords, size))[0]
+    return np.unique(keys, return_inverse=True)[1].astype(np.int32)
+
+
+def hex_labels(coords, size=2000.0):
+    """
+    Label points by hexagonal cell (pointy top, size is distance from center
+    to corner)
+
+    Arguments:
+        coords      Numpy array n x 2
+        size        Size of hexagon in metres
+
+    Return:
+        Numpy array of labels
+    """
+    q = (np.sqrt(3) / 3 * coords[:, 0] - coords[:, 1] / 3) / size
+    r = (2 / 3 * coords[:, 1]) / size
+    s = -q - r
+    # Zaokrouhleni v krychlovych souradnicich, opravi se slozka s nejvetsi chybou
+    rq, rr, rs = np.round(q), np.round(r), np.round(s)
+    dq, dr, ds = np.abs(rq - q), np.abs(rr - r), np.abs(rs - s)
+    fix_q = (dq > dr) & (dq > ds)
+    fix_r = ~fix_q & (dr > ds)
+    rq[fix_q] = -rr[fix_q] - rs[fix_q]
+    rr[fix_r] = -rq[fix_r] - rs[fix_r]
+    keys = cell_keys(np.stack([rq, rr], axis=1).astype(np.int64))[0]
+    return np.unique(keys, return_inverse=True)[1].astype(np.int32)
+
+
+def density_labels(coords, eps=500.0, min_samples=10):
+    """
+    Density based clustering on grid index (approximation of DBSCAN)
+
+    Points are indexed by cells of size eps / sqrt(2), cell with at least
+    min_samples points is dense. Touching dense cells form one cluster,
+    points in other cells are noise.
+
+    Arguments:
+        coords      Numpy array n x 2
+        eps         Distance of neighbouring points in metres
+        min_samples Number of points of dense cell
+
+    Return:
+        Numpy array of labels, noise is -1
+    """
+    labels = np.full(len(coords), -1, dtype=np.int32)
+    if len(coords) == 0:
+        return labels
+    keys, width = cell_keys(grid_cells(coords, eps / np.sqrt(2)), margin=1)
+    uniques, inverse, counts = np.unique(keys, return_inverse=True, return_counts=True)
+    dense = np.flatnonzero(counts >= min_samples)
+    if len(dense) == 0:
+        return labels
+
+    # Husta pole jsou serazena podle klice, sousede se hledaji binarnim vyhledavanim
+    keys = uniques[dense]
+    component = np.arange(len(dense))
+    neighbours = []
+    for dx in (-1, 0, 1):
+        for dy in (-1, 0, 1):
+            if dx != 0 or dy != 0:
+                position = np.searchsorted(keys, keys + dx * width + dy).clip(0, len(keys) - 1)
+                found = keys[position] == keys + dx * width + dy
+                neighbours.append((np.flatnonzero(found), position[found]))
+
+    # Sireni nejmensiho oznaceni se zkracovanim cest, dokud se neco meni
+    while True:
+        previous = component.copy()
+        for cell, neighbour in neighbours:
+            np.minimum.at(component, cell, component[neighbour])
+        component = component[component]
+        if np.array_equal(component, previous):
+            break
+
+    cell_labels = np.full(len(uniques), -1, dtype=np.int32)
+    cell_labels[dense] = np.unique(component, return_inverse=True)[1]
+    return cell_labels[inverse]
+
+
+ENGINES = {
+    'kmeans': kmeans_labels,
+    'grid': grid_labels,
+    'hex': hex_labels,
+    'density': density_labels,
+}
+
+
+def prune_labels(folder, keep=MAX_LABELS):
+    """
+    Remove least recently used stored labels from folder
+
+    Arguments:
+        folder  Folder with stored labels
+        keep    Number of files which are kept
+    """
+    paths = [os.path.join(folder, name) for name in os.listdir(folder)
+             if name.endswith('.npy') and '.tmp' not in name]
+    paths.sort(key=os.path.getmtime, reverse=True)
+    for path in paths[keep:]:
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+
+
+def cluster_points(coords, engine='kmeans', folder='data', **params):
+    """
+    Get cluster labels of points, assignments are cached
+
+    Labels are kept in memory and stored in folder/clusters, key is hash of
+    coordinates, engine and its parameters, so replot of the same region
+    and road class does not fit again. Only MAX_LABELS most recently used
+    assignments are kept in memory and in folder.
+
+    Arguments:
+        coords      Numpy array n x 2 in EPSG:3857
+        engine      Name of engine from ENGINES
+        folder      Folder with cache (not stored if it does not exist)
+        params      Parameters of engine
+
+    Return:
+        Numpy array of labels, noise is -1
+    """
+    coords = np.ascontiguousarray(coords, dtype=np.float64)
+    digest = hashlib.sha1(coords.tobytes())
+    digest.update(json.dumps([VERSION, engine, params], sort_keys=True).encode())
+    key = digest.hexdigest()
+    if key in _labels:
+        _labels.move_to_end(key)
+        return _labels[key]
+
+    path = f"./{folder}/clusters/{key}.npy"
+    if os.path.exists(path):
+        labels = np.load(path)
+        os.utime(path)
+    else:
+        labels = ENGINES[engine](coords, **params)
+        if os.path.isdir(folder):
+            os.makedirs(f"./{folder}/clusters", exist_ok=True)
+            np.save(path + '.tmp.npy', labels)
+            os.replace(path + '.tmp.npy', path)
+            prune_labels(f"./{folder}/clusters")
+    _labels[key] = labels
+    while len(_labels) > MAX_LABELS:
+        _labels.popitem(last=False)
+    return labels
+
+
+def cluster_groups(df, engine='kmeans', by=('region', 'p36'), folder='data', **params):
+    """
+    Cluster every region and road class separately
+
+    Arguments:
+        df          DataFrame with columns x, y and columns of by
+        engine      Name of engine from ENGINES
+        by          Columns which split data to separately clustered groups
+        folder      Folder with cache
+        params      Parameters of engine
+
+    Return:
+        Numpy array of labels unique over all groups, noise is -1
+    """
+    coords = np.column_stack([df['x'].to_numpy(), df['y'].to_numpy()])
+    labels = np.full(len(df), -1, dtype=np.int64)
+    offset = 0
+    groups = [np.arange(len(df))] if not by else \
+        df.reset_index(drop=True).groupby(list(by), observed=True, sort=True).indices.values()
+    for rows in groups:
+        group_labels = cluster_points(coords[rows], engine, folder, **params)
+        clustered = group_labels >= 0
+        labels[rows[clustered]] = group_labels[clustered] + offset
+        offset += int(group_labels.max()) + 1 if clustered.any() else 0
+    return labels
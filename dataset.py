@@ -0,0 +1,233 @@
+#!/usr/bin/env python3
+"""
+Lazy queries over columnar cache of accident data
+Author: Karel Norek, xnorek01
+"""
+# -*- coding: utf-8 -*-
+import numpy as np
+
+from download import DataDownloader
+from aggregate import factorize
+
+
+def matches(value, condition):
+    """
+    Check if value matches condition of DataDownloader.filter_mask
+
+    Arguments:
+        value       Value in decoded form
+        condition   Tuple (low, high), list or set, or value
+
+    Return:
+        True if value matches condition
+    """
+    if isinstance(condition, tuple):
+        low, high = condition
+        return (low is None or value >= low) and (high is None or value <= high)
+    if isinstance(condition, (list, set)):
+        return value in condition
+    return value == condition
+
+
+def merge_conditions(first, second):
+    """
+    Merge two conditions on one column to one condition matching both
+
+    Arguments:
+        first, second   Conditions, see DataDownloader.filter_mask
+
+    Return:
+        Condition, empty list if no value can match
+    """
+    if isinstance(second, (list, set)) and not isinstance(first, (list, set)):
+        first, second = second, first
+    if isinstance(first, (list, set)):
+        return [value for value in first if matches(value, second)]
+    if isinstance(first, tuple) and isinstance(second, tuple):
+        lows = [bound for bound in (first[0], second[0]) if bound is not None]
+        highs = [bound for bound in (first[1], second[1]) if bound is not None]
+        return (max(lows) if lows else None, min(highs) if highs else None)
+    if isinstance(first, tuple):
+        first, second = second, first
+    return first if matches(first, second) else []
+
+
+class AccidentDataset:
+    """
+    Lazy query over DataDownloader cache
+
+    Operations only record plan and return new dataset, data are read on
+    collect. Condition on region chooses regions which are read at all,
+    other conditions and selected columns are passed to get_dict, so only
+    needed columns of needed regions are read from cache.
+
+    Example:
+        AccidentDataset().filter(region=['JHM', 'PHA'], p36=1) \\
+            .groupby('region', 'p21').count().collect()
+    """
+
+    def __init__(self, downloader=None, decode=True):
+        """
+        Initialize dataset over all regions and columns
+
+        Arguments:
+            downloader  DataDownloader (default DataDownloader())
+            decode      Decode dictionary encoded columns, see get_dict
+        """
+        self.downloader = DataDownloader() if downloader is None else downloader
+        self.decode = decode
+        self.where = {}
+        self.columns = None
+        self.keys = None
+        self.aggregates = None
+
+    def _replace(self, **changes):
+        """
+        Get copy of dataset with changed plan
+        """
+        dataset = object.__new__(AccidentDataset)
+        dataset.__dict__.update(self.__dict__, **changes)
+        return dataset
+
+    def filter(self, where=None, **conditions):
+        """
+        Keep only rows matching all conditions
+
+        Arguments:
+            where       Dictionary column : condition, see filter_mask
+            conditions  The same as keyword arguments
+
+        Return:
+            AccidentDataset
+        """
+        if self.keys is not None:
+            raise ValueError("filter after groupby is not supported")
+        merged = dict(self.where)
+        for column, condition in {**(where or {}), **conditions}.items():
+            merged[column] = merge_conditions(merged[column], condition) if column in merged else condition
+        return self._replace(where=merged)
+
+    def select(self, *columns):
+        """
+        Keep only columns
+
+        Arguments:
+            columns     Names of columns
+
+        Return:
+            AccidentDataset
+        """
+        if self.keys is not None:
+            raise ValueError("select after groupby is not supported")
+        if self.columns is not None and not set(columns) <= set(self.columns):
+            raise ValueError(f"columns {sorted(set(columns) - set(self.columns))} are not selected")
+        return self._replace(columns=list(columns))
+
+    def groupby(self, *keys):
+        """
+        Group rows by keys, must be followed by count or sum
+
+        Arguments:
+            keys    Names of columns
+
+        Return:
+            AccidentDataset
+        """
+        return self._replace(keys=list(keys), aggregates={})
+
+    def count(self, name='count'):
+        """
+        Count rows of every group
+
+        Arguments:
+            name    Name of result column
+
+        Return:
+            AccidentDataset
+        """
+        return self._replace(keys=self.keys or [], aggregates={**(self.aggregates or {}), name: None})
+
+    def sum(self, *columns):
+        """
+        Sum columns for every group
+
+        Arguments:
+            columns     Names of numeric columns
+
+        Return:
+            AccidentDataset
+        """
+        aggregates = {column: column for column in columns}
+        return self._replace(keys=self.keys or [], aggregates={**(self.aggregates or {}), **aggregates})
+
+    def plan(self):
+        """
+        Get plan of query
+
+        Return:
+            Dictionary with regions and columns which are read, conditions
+            passed to get_dict, keys and aggregates
+        """
+        where = dict(self.where)
+        region = where.pop('region', None)
+        regions = list(self.downloader.regions.keys())
+        if region is not None:
+            regions = [code for code in regions if matches(code, region)]
+
+        if self.keys is not None:
+            columns = self.keys + [column for column in self.aggregates.values() if column is not None]
+        elif self.columns is not None:
+            columns = list(self.columns)
+        else:
+            columns = self.downloader.headers + ['region']
+        return {'regions': regions, 'columns': list(dict.fromkeys(columns)), 'where': where,
+                'keys': self.keys, 'aggregates': self.aggregates}
+
+    def collect(self):
+        """
+        Execute query
+
+        Return:
+            Dictionary column : numpy array like get_dict, grouped query has
+            key columns and aggregate columns with one row for every group
+            present in data, sorted by stored values of keys (codes for
+            dictionary encoded columns)
+        """
+        plan = self.plan()
+        # Pro pocet bez klicu staci nejmensi sloupec, bez sloupce nelze urcit pocet radku
+        columns = plan['columns'] or ['p36']
+        if plan['keys'] is None:
+            data = self.downloader.get_dict(plan['regions'], columns=columns, where=plan['where'] or None,
+                                            decode=self.decode)
+            return {column: data[column] for column in plan['columns']}
+
+        # Skupiny se pocitaji nad kody, dekoduji se az hodnoty klicu
+        data = self.downloader.get_dict(plan['regions'], columns=columns, where=plan['where'] or None,
+                                        decode=False)
+        rows = len(data[columns[0]])
+        domains = []
+        key = np.zeros(rows, dtype=np.int64)
+        for column in plan['keys']:
+            domain, codes = factorize(data[column])
+            domains.append(domain)
+            key = key * len(domain) + codes
+
+        shape = [len(domain) for domain in domains]
+        if int(np.prod(shape)) <= max(rows, 1):
+            counts = np.bincount(key, minlength=int(np.prod(shape)))
+            groups = np.flatnonzero(counts)
+            inverse = np.searchsorted(groups, key)
+        else:
+            groups, inverse = np.unique(key, return_inverse=True)
+
+        result = {}
+        positions = np.unravel_index(groups, shape) if shape else []
+        for column, domain, position in zip(plan['keys'], domains, positions):
+            values = domain[position]
+            result[column] = self.downloader.decode_column(column, values) if self.decode else values
+        for name, column in plan['aggregates'].items():
+            if column is None:
+                result[name] = np.bincount(inverse, minlength=len(groups))
+            else:
+                result[name] = np.bincount(inverse, data[column].astype(np.float64), minlength=len(groups))
+        return result
@@ -5,6 +5,10 @@ import pandas as pd
 import seaborn as sns
 import numpy as np
 import math
+import argparse
+
+from aggregate import count_by, count_chunks
+from download import DataDownloader
 
 road_types = {
     0: "Žádná z uvedených",
@@ -24,18 +28,29 @@ def get_df():
     return df
 
 
-def get_police_df(df: pd.DataFrame, columns: list):
+def get_police_mask(df: pd.DataFrame):
     """
-    Get police data
+    Get mask of accidents involving the police
 
     Arguments:
         df - dataframe with data
-        columns - wanted columns
     """
-    df[df['p48a'] == 13] == 12
-    df = df[df['p48a'] == 12]
-    df = df[columns]
-    return df
+    return (df['p48a'] == 12).to_numpy()
+
+
+def get_police_counts(df, keys):
+    """
+    Count accidents involving the police for every combination of keys
+
+    Arguments:
+        df - dataframe with data or DataDownloader, cache of downloader
+            is read by blocks of rows, so memory does not depend on number
+            of accidents
+        keys - list of columns
+    """
+    if isinstance(df, DataDownloader):
+        return count_chunks(df.iter_chunks(columns=keys, where={'p48a': 12}), keys)
+    return count_by(df, keys, get_police_mask(df))
 
 
 def print_police_stats(df: pd.DataFrame):
@@ -43,17 +58,15 @@ def print_police_stats(df: pd.DataFrame):
     Print police statistics
 
     Arguments:
-        df - dataframe with data
+        df - dataframe with data or DataDownloader, see get_police_counts
     """
-    df = get_police_df(df, ['region'])
-    print(f"Total number of police accidents: {df.shape[0]}")
+    df = get_police_counts(df, ['region'])
+    print(f"Total number of police accidents: {df['count'].sum()}")
 
-    df['tmp'] = 1
-    df = df.groupby(['region']).agg('sum').reset_index()
-    df = df.sort_values(by='tmp').reset_index()
-    print(f"Lowest number of accidents involving police: {df.iloc[0]['tmp']} in region {df.iloc[0]['region']}")
-    print(f"Highest number of accidents involving police: {df.iloc[-1]['tmp']} in region {df.iloc[-1]['region']}")
-    print(f"Mean: {math.ceil(df['tmp'].mean())}")
+    df = df.sort_values(by='count').reset_index()
+    print(f"Lowest number of accidents involving police: {df.iloc[0]['count']} in region {df.iloc[0]['region']}")
+    print(f"Highest number of accidents involving police: {df.iloc[-1]['count']} in region {df.iloc[-1]['region']}")
+    print(f"Mean: {math.ceil(df['count'].mean())}")
 
 
 def print_table(df: pd.DataFrame):
@@ -61,22 +74,17 @@ def print_table(df: pd.DataFrame):
     Print LaTeX table with police data
 
     Arguments:
-        df - dataframe with data
+        df - dataframe with data or DataDownloader, see get_police_counts
     """
-    df = get_police_df(df, ['p2a', 'p21'])
-    df['p2a'] = pd.to_datetime(df['p2a'])
+    df = get_police_counts(df, ['p2a', 'p21'])
+    df['Rok'] = pd.to_datetime(df['p2a']).dt.year
     df.loc[df['p21'] == 4, 'p21'] = 3
-    df['p21'] = df['p21'].map(road_types)
-    df['tmp'] = 1
-
-    df.rename(columns={'p2a': 'Rok', 'p21': 'Druh komunikace'}, inplace=True)
+    df['Druh komunikace'] = df['p21'].map(road_types)
 
-    df = df.pivot_table(columns='Druh komunikace', values='tmp', aggfunc='sum',
-                        index=['Rok']).reset_index()
-    df = df.fillna(0)
-    df = df.resample('Y', on='Rok').sum().reset_index()
-    df['Rok'] = df['Rok'].dt.year
-    df = df.set_index('Rok')
+    df = df.pivot_table(columns='Druh komunikace', values='count', aggfunc='sum',
+                        index=['Rok'], fill_value=0)
+    df = df.reindex(range(df.index.min(), df.index.max() + 1), fill_value=0)
+    df.index.name = 'Rok'
     print(f"\nLatex table:\n{df.to_latex()}")
 
 
@@ -85,16 +93,14 @@ def police_plot(df: pd.DataFrame, fig_location: str = None):
     Plot number of accidents involving the police
 
     Arguments:
-        df - dataframe with data
+        df - dataframe with data or DataDownloader, see get_police_counts
         fig_location - plot location
     """
-    df = get_police_df(df, ['region'])
-    df['tmp'] = 1
-    df = df.groupby(['region']).agg('sum').reset_index()
+    df = get_police_counts(df, ['region'])
 
     sns.set_style('darkgrid')
 
-    ax = sns.barplot(x='region', y='tmp', data=df, palette='rocket')
+    ax = sns.barplot(x='region', y='count', data=df, palette='rocket')
     ax.set_title('Počet nehod, kterých byla součástí policie v jednotlivých krajích', weight='bold')
     ax.set(xlabel='Kraj', ylabel='Počet nehod')
     for c in ax.containers:
@@ -106,7 +112,11 @@ def police_plot(df: pd.DataFrame, fig_location: str = None):
 
 
 if __name__ == "__main__":
-    df = get_df()
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--stream', default=False, action='store_true',
+                        help='aggregate cache of DataDownloader by blocks instead of loading accidents.pkl.gz')
+    args = parser.parse_args()
+    df = DataDownloader() if args.stream else get_df()
     print_police_stats(df)
     print_table(df)
     police_plot(df, 'fig.png')
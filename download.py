@@ -11,14 +11,236 @@ import csv
 import os
 import re
 import io
-import gzip
-import pickle
+import shutil
+import itertools
+import concurrent.futures
+import threading
+import collections
+import json
+import time
+import hashlib
+import fcntl
 from bs4 import BeautifulSoup
 
+import projection
+
 # Kromě vestavěných knihoven (os, sys, re, requests …) byste si měli vystačit s: gzip, pickle, csv, zipfile, numpy, matplotlib, BeautifulSoup.
 # Další knihovny je možné použít po schválení opravujícím (např ve fóru WIS).
 
 
+class ColumnBuffer:
+    """
+    Typed buffer for one column which grows geometrically
+
+    Attributes:
+        dtype   Wanted type of column, if some values can not be converted
+                whole column is stored as strings
+        data    Numpy array with data, only first size items are valid
+        size    Number of valid items
+        missing Number of first rows of column which were dropped when
+                conversion failed, their strings must be added by prepend
+    """
+
+    def __init__(self, dtype, capacity=1024):
+        """
+        Initialize buffer
+
+        Arguments:
+            dtype       Wanted type of column
+            capacity    Initial size of buffer
+        """
+        self.dtype = dtype
+        self.capacity = capacity
+        self.data = None
+        self.size = 0
+        self.missing = 0
+
+    def append(self, values):
+        """
+        Convert values to column type and append them to buffer
+
+        Arguments:
+            values  Numpy array of cleaned strings
+        """
+        if self.dtype is not np.str_:
+            try:
+                values = values.astype(self.dtype)
+            except ValueError:
+                # Stejne jako drive zustane cely sloupec jako retezce, prevod uz
+                # prevedenych hodnot zpet by je zmenil ('07' -> '7'), nactou se znovu
+                self.dtype = np.str_
+                self.missing += self.size
+                self.data = None
+                self.size = 0
+
+        if values.dtype.kind == 'U' and len(values) != 0:
+            # Retezce maji sirku nejdelsi hodnoty v celem bloku, ne ve sloupci
+            values = values.astype(f"U{max(np.char.str_len(values).max(), 1)}")
+
+        if self.data is None:
+            self.data = np.empty(max(self.capacity, len(values)), dtype=values.dtype)
+        elif self.data.dtype != values.dtype:
+            self.data = self.data.astype(np.result_type(self.data, values))
+
+        end = self.size + len(values)
+        if end > len(self.data):
+            self.data.resize(max(end, 2 * len(self.data)), refcheck=False)
+        self.data[self.size:end] = values
+        self.size = end
+
+    def prepend(self, values):
+        """
+        Add strings of dropped first rows
+
+        Arguments:
+            values  Numpy array of cleaned strings (missing items)
+        """
+        self.data = np.concatenate((values, self.finish()))
+        self.size = len(self.data)
+        self.missing = 0
+
+    def finish(self):
+        """
+        Shrink buffer to its size
+
+        Return:
+            Numpy array with data
+        """
+        if self.data is None:
+            return np.zeros(0, dtype=self.dtype)
+        self.data.resize(self.size, refcheck=False)
+        return self.data
+
+
+class LRUCache:
+    """
+    Cache of region data bounded by size in bytes, least recently used
+    regions are evicted first
+
+    Stored arrays are in memory (columns read from memory mapped cache),
+    so hot regions are not read from disk again.
+
+    Attributes:
+        max_bytes   Maximal size of stored numpy arrays
+        resident    Current size of stored numpy arrays
+        hits, misses, evictions     Statistics of cache usage
+    """
+
+    def __init__(self, max_bytes=1 << 30):
+        """
+        Initialize cache
+
+        Arguments:
+            max_bytes   Maximal size of stored numpy arrays
+        """
+        self.max_bytes = max_bytes
+        self.entries = collections.OrderedDict()
+        self.resident = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def size(stats):
+        """
+        Get size of region data in memory
+
+        Arguments:
+            stats   Dictionary column : numpy array
+
+        Return:
+            Size of arrays in bytes
+        """
+        return sum(values.nbytes for values in stats.values())
+
+    def __contains__(self, key):
+        with self.lock:
+            return key in self.entries
+
+    def get(self, key):
+        """
+        Get region data and mark them as recently used
+
+        Arguments:
+            key     Key of region
+
+        Return:
+            Dictionary column : numpy array or None
+        """
+        with self.lock:
+            if key not in self.entries:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self.entries.move_to_end(key)
+            return self.entries[key]
+
+    def put(self, key, stats):
+        """
+        Store region data, evict least recently used regions if needed
+
+        Data larger than max_bytes are not stored.
+
+        Arguments:
+            key     Key of region
+            stats   Dictionary column : numpy array
+        """
+        size = self.size(stats)
+        with self.lock:
+            if key in self.entries:
+                self.remove(key)
+            if size > self.max_bytes:
+                return
+            while self.resident + size > self.max_bytes:
+                self.remove(next(iter(self.entries)))
+                self.evictions += 1
+            self.entries[key] = stats
+            self.resident += size
+
+    def remove(self, key):
+        """
+        Remove region data and their sizes, caller holds lock
+
+        Arguments:
+            key     Key of region
+        """
+        stats = self.entries.pop(key)
+        self.resident -= self.size(stats)
+
+    def pop(self, key):
+        """
+        Remove region data from cache
+
+        Arguments:
+            key     Key of region
+        """
+        with self.lock:
+            if key in self.entries:
+                self.remove(key)
+
+    def clear(self):
+        """
+            Remove everything from cache
+        """
+        with self.lock:
+            self.entries.clear()
+            self.resident = 0
+
+    def stats(self):
+        """
+        Get statistics of cache
+
+        Return:
+            Dictionary with hits, misses, evictions, entries, resident and
+            max_bytes
+        """
+        with self.lock:
+            return {'hits': self.hits, 'misses': self.misses, 'evictions': self.evictions,
+                    'entries': len(self.entries), 'resident': self.resident,
+                    'max_bytes': self.max_bytes}
+
+
 class DataDownloader:
     """
     Class for downloading and parsing data
@@ -27,9 +249,33 @@ class DataDownloader:
         headers    Nazvy hlavicek jednotlivych CSV souboru, tyto nazvy nemente!
         regions    Dictionary s nazvy kraju : nazev csv souboru
         headers_type Array type for headers
-        cache       Cache attribute
+        cache       LRUCache with loaded regions, shared_cache by default
+        shared_cache    LRUCache shared by all instances in process
+        category_columns    Columns stored as integer codes into categories,
+                            other string columns are stored as ASCII bytes
+        categories_folder   Folder (inside folder) with categories of columns
+        shared_categories   Loaded categories shared by all instances in process
+        shared_validated    Region caches checked against archives in this process
+        chunk_rows  Number of CSV rows parsed at once
+        block_rows  Number of cached rows read at once by iter_chunks
+        download_workers    Number of archives downloaded at once
+        download_chunk      Size of chunk written while downloading
+        download_timeout    Timeout of requests in seconds
+        manifest_filename   Name of file in folder with list of archives
     """
 
+    chunk_rows = 65536
+    block_rows = 1 << 18
+    download_workers = 4
+    download_chunk = 1 << 20
+    download_timeout = 30
+    manifest_filename = "manifest.json"
+    shared_cache = LRUCache()
+    category_columns = ["h", "i", "j", "k", "l", "o", "p", "q", "t", "region"]
+    categories_folder = "categories"
+    shared_categories = {}
+    shared_validated = set()
+
     headers = ["p1", "p36", "p37", "p2a", "weekday(p2a)", "p2b", "p6", "p7", "p8", "p9", "p10", "p11", "p12", "p13a",
                "p13b", "p13c", "p14", "p15", "p16", "p17", "p18", "p19", "p20", "p21", "p22", "p23", "p24", "p27", "p28",
                "p34", "p35", "p39", "p44", "p45a", "p47", "p48a", "p49", "p50a", "p50b", "p51", "p52", "p53", "p55a",
@@ -61,25 +307,35 @@ class DataDownloader:
         "KVK": "19",
     }
 
-    def __init__(self, url="https://ehw.fit.vutbr.cz/izv/", folder="data", cache_filename="data_{}.pkl.gz"):
+    def __init__(self, url="https://ehw.fit.vutbr.cz/izv/", folder="data", cache_filename="data_{}",
+                 manifest_ttl=24 * 3600, offline=False, cache=None):
         """
         Initialize class
 
         Arguments:
             url     Url where data can be downloaded
             folder  Folder where to store downloaded data
-            cache_filename  Name of cache file
+            cache_filename  Name of directory with columnar cache of region
+            manifest_ttl    How long (in seconds) is list of archives considered fresh
+            offline         Never connect to url, use only downloaded archives
+            cache           LRUCache for loaded regions (default shared_cache)
         """
         self.url = url
         self.folder = folder
         self.cache_filename = cache_filename
-        self.cache = {}
+        self.manifest_ttl = manifest_ttl
+        self.offline = offline
+        self.synced = False
+        self.cache = self.shared_cache if cache is None else cache
         if self.folder not in os.listdir():
             os.mkdir(self.folder)
 
-    def download_data(self):
+    def get_links(self):
         """
-            Download data from url
+        Get links to all archives from url
+
+        Return:
+            List of urls of zip archives
         """
         s = requests.session()
         response = s.get(self.url)
@@ -91,14 +347,227 @@ class DataDownloader:
             button = entry.find_all(class_='btn btn-sm btn-primary')[-1]
             link = re.split('[(\']*[\')]', button['onclick'])[1]
             links.append(self.url + link)
+        return links
+
+    def download_data(self):
+        """
+            Download data from url
 
+            Archives are downloaded concurrently by download_workers threads.
+            Already downloaded archives are checked with conditional requests
+            (ETag, Last-Modified) and unfinished downloads are resumed.
+            List of archives and their checksums is stored in manifest.
+        """
+        links = self.get_links()
+        manifest = self.load_manifest()
+        lock = threading.Lock()
+
+        with concurrent.futures.ThreadPoolExecutor(max_workers=self.download_workers) as executor:
+            futures = [executor.submit(self.download_file, link, manifest, lock) for link in links]
+            for future in futures:
+                future.result()
+
+        archives = {}
         for link in links:
             filename = link.split('/')[-1]
-            if filename not in os.listdir(f"./{self.folder}"):
-                with open(f"./{self.folder}/{filename}", 'wb') as fp:
-                    with requests.get(link, stream=True) as r:
-                        for chunk in r.iter_content(chunk_size=128, decode_unicode=True):
-                            fp.write(chunk)
+            info = dict(manifest['archives'].get(filename, {}))
+            path = f"./{self.folder}/{filename}"
+            stat = os.stat(path)
+            if info.get('size') != stat.st_size or info.get('mtime') != stat.st_mtime or 'sha256' not in info:
+                info['sha256'] = self.file_checksum(path)
+            info.update(url=link, size=stat.st_size, mtime=stat.st_mtime)
+            archives[filename] = info
+
+        manifest['archives'] = archives
+        manifest['timestamp'] = time.time()
+        self.save_manifest(manifest)
+        self.synced = True
+        # Archivy se mohly zmenit, cache kraju se znovu porovnaji
+        folder = os.path.abspath(self.folder)
+        self.shared_validated.difference_update({key for key in self.shared_validated if key[0] == folder})
+
+    def ensure_data(self):
+        """
+        Download data only if it is needed
+
+        Index page is scraped at most once per instance and only if the manifest
+        is older than manifest_ttl or some archive from it is missing.
+        """
+        if self.synced:
+            return
+
+        manifest = self.load_manifest()
+        fresh = time.time() - manifest['timestamp'] < self.manifest_ttl
+        present = all(os.path.exists(f"./{self.folder}/{filename}")
+                      and os.path.getsize(f"./{self.folder}/{filename}") == info.get('size')
+                      for filename, info in manifest['archives'].items())
+
+        if self.offline or (fresh and present and manifest['archives'] != {}):
+            self.synced = True
+        else:
+            self.download_data()
+
+    def load_manifest(self):
+        """
+        Load manifest with list of archives
+
+        Return:
+            Dictionary with time of last check (timestamp) and archives
+            (filename : url, size, sha256 and HTTP validators)
+        """
+        path = f"./{self.folder}/{self.manifest_filename}"
+        if not os.path.exists(path):
+            return {'timestamp': 0, 'archives': {}}
+        with open(path, 'r') as fp:
+            return json.load(fp)
+
+    def save_manifest(self, manifest):
+        """
+        Atomically save manifest
+
+        Arguments:
+            manifest    Dictionary from load_manifest
+        """
+        path = f"./{self.folder}/{self.manifest_filename}"
+        with open(path + '.tmp', 'w') as fp:
+            json.dump(manifest, fp, indent=1)
+        os.replace(path + '.tmp', path)
+
+    @staticmethod
+    def file_checksum(path):
+        """
+        Compute SHA-256 of file
+
+        Arguments:
+            path    Path to file
+
+        Return:
+            Hexadecimal digest
+        """
+        sha = hashlib.sha256()
+        with open(path, 'rb') as fp:
+            for block in iter(lambda: fp.read(1 << 20), b''):
+                sha.update(block)
+        return sha.hexdigest()
+
+    def download_file(self, link, manifest, lock):
+        """
+        Download one archive
+
+        Complete file is requested only if it changed on server, partial file
+        (.part) is resumed with Range request. Part which is already whole
+        (server answers 416 with its size) is only renamed, other unsatisfiable
+        part is downloaded again. File is renamed to its final name after whole
+        file was downloaded, only then its validators replace validators of the
+        previous version in manifest.
+
+        Arguments:
+            link        Url of archive
+            manifest    Shared manifest with validators of archives
+            lock        Lock guarding manifest
+        """
+        filename = link.split('/')[-1]
+        path = f"./{self.folder}/{filename}"
+        part = path + '.part'
+        with lock:
+            info = dict(manifest['archives'].get(filename, {}))
+        # Validatory stahovane verze jsou v 'pending', dokud neni soubor cely
+        pending = info.pop('pending', None)
+
+        headers = {}
+        if os.path.exists(part) and pending:
+            validator = pending.get('etag', pending.get('last_modified'))
+            if validator is not None:
+                headers['Range'] = f"bytes={os.path.getsize(part)}-"
+                headers['If-Range'] = validator
+        elif os.path.exists(path):
+            if 'etag' not in info and 'last_modified' not in info:
+                # Soubor stazeny starsi verzi, nemame podle ceho overit zmenu
+                return
+            if 'etag' in info:
+                headers['If-None-Match'] = info['etag']
+            if 'last_modified' in info:
+                headers['If-Modified-Since'] = info['last_modified']
+
+        with requests.get(link, headers=headers, stream=True, timeout=self.download_timeout) as r:
+            if r.status_code == 304:
+                return
+            if r.status_code == 416 and 'Range' in headers:
+                # Cely .part zustal po preruseni pred prejmenovanim, jinak se stahne znovu
+                if r.headers.get('Content-Range', '').rpartition('/')[2] != str(os.path.getsize(part)):
+                    os.remove(part)
+                    return self.download_file(link, manifest, lock)
+            else:
+                r.raise_for_status()
+
+                pending = {}
+                if 'ETag' in r.headers:
+                    pending['etag'] = r.headers['ETag']
+                if 'Last-Modified' in r.headers:
+                    pending['last_modified'] = r.headers['Last-Modified']
+                with lock:
+                    manifest['archives'][filename] = {**info, 'pending': pending}
+                    self.save_manifest(manifest)
+
+                with open(part, 'ab' if r.status_code == 206 else 'wb') as fp:
+                    for chunk in r.iter_content(chunk_size=self.download_chunk):
+                        fp.write(chunk)
+
+        os.replace(part, path)
+        with lock:
+            manifest['archives'][filename] = pending
+            self.save_manifest(manifest)
+
+    @staticmethod
+    def clean_value(elem):
+        """
+        Clean one value from CSV file
+
+        Arguments:
+            elem    String to be cleaned
+
+        Return:
+            Value without [A-G]: prefixes, with decimal dot and -1 for empty value
+        """
+        letters = re.findall(r"[A-G]:", elem)
+        if letters != []:
+            for letter in letters:
+                elem = elem.replace(letter, '')
+        if ',' in elem:
+            elem = elem.replace(',', '.')
+        if elem == '':
+            elem = '-1'
+        return elem
+
+    @classmethod
+    def clean_column(cls, column):
+        """
+        Clean whole column at once, rules are same as in clean_value
+
+        Rules are applied only when the column contains something to clean,
+        letters are stripped only from unique values which contain ':'.
+
+        Arguments:
+            column  Numpy array of strings
+
+        Return:
+            Cleaned numpy array
+        """
+        colons = np.char.find(column, ':') >= 0
+        if colons.any():
+            column = column.copy()
+            values, inverse = np.unique(column[colons], return_inverse=True)
+            column[colons] = np.array([cls.clean_value(value) for value in values], dtype=column.dtype)[inverse]
+
+        if (np.char.find(column, ',') >= 0).any():
+            column = np.char.replace(column, ',', '.')
+
+        empty = column == ''
+        if empty.any():
+            column = column.astype(np.result_type(column, '<U2'))
+            column[empty] = '-1'
+
+        return column
 
     def parse_region_data(self, region):
         """
@@ -111,84 +580,714 @@ class DataDownloader:
             Function return dictionary, where keys are headers
             and values are numpy arrays with data
         """
-        self.download_data()
+        return self.parse_regions_data([region])[region]
 
-        archives = []
-        for f in os.listdir(f"./{self.folder}"):
-            if re.match(r"^.*\.zip", f) is not None:
-                archives.append(f)
+    def parse_regions_data(self, regions, workers=None):
+        """
+        Parse data of more regions with one pass over every archive
 
-        array = np.zeros((0, 64))
-        for archiv in archives:
+        Arguments:
+            regions List of regions to be parsed
+            workers Number of processes used for parsing, see parse_archives
+
+        Return:
+            Function return dictionary region : dictionary from parse_region_data
+        """
+        self.ensure_data()
+        return self.parse_archives(regions, workers)
+
+    def parse_archives(self, regions, workers=None):
+        """
+        Parse already downloaded archives for given regions
+
+        If workers is greater than 1, regions are split into groups and every
+        group is parsed in its own process with one pass over the archives.
+
+        Arguments:
+            regions List of regions to be parsed
+            workers Number of processes used for parsing (None means serial)
+
+        Return:
+            Function return dictionary region : dictionary from parse_region_data
+        """
+        parsed = self.parse_members(regions, workers=workers)
+        return {region: stats for region, (stats, members) in parsed.items()}
+
+    def archive_members(self, regions):
+        """
+        List CSV files of regions in downloaded archives
+
+        Only central directories of archives are read, CRC-32 and size of file
+        identify its content.
+
+        Arguments:
+            regions List of regions
+
+        Return:
+            Dictionary region : list of members (archive, member, crc, size)
+        """
+        codes = {self.regions[region]: region for region in regions}
+        result = {region: [] for region in regions}
+        for archiv in sorted(os.listdir(f"./{self.folder}")):
+            if re.match(r"^.*\.zip$", archiv) is None:
+                continue
             with zipfile.ZipFile(f"./{self.folder}/{archiv}", 'r') as zf:
-                for file in zf.namelist():
-                    if self.regions[region] == file.split('.csv')[0]:
-                        with zf.open(file, 'r') as csvfile:
-                            reader = csv.reader(io.TextIOWrapper(csvfile, 'cp1250'), delimiter=';')
-                            foo = np.array(list(reader))
-
-                        array = np.concatenate((array, foo))
-        array = np.insert(array, 0, region, axis=1)
-        array = np.transpose(array)
-
-        for index, arr in enumerate(array):
-            for index_in, elem in enumerate(arr):
-                letters = re.findall(r"[A-G]:", elem)
-                if letters != []:
-                    for letter in letters:
-                        elem = elem.replace(letter, '')
-                if ',' in elem:
-                    elem = elem.replace(',', '.')
-                if elem == '':
-                    elem = -1
-                arr[index_in] = elem
-
-        result = {self.headers[x]: array[x + 1] for x, value in enumerate(self.headers)}
-        result[region] = array[0]
-
-        for index, header in enumerate(self.headers):
-            try:
-                result[header] = result[header].astype(self.headers_types[index])
-            except ValueError:
-                pass
+                for info in zf.infolist():
+                    region = codes.get(info.filename.split('.csv')[0])
+                    if region is not None:
+                        result[region].append({'archive': archiv, 'member': info.filename,
+                                               'crc': info.CRC, 'size': info.file_size})
+        return result
+
+    @staticmethod
+    def member_key(member):
+        """
+        Get key identifying content of archive member
+
+        Arguments:
+            member  Member from archive_members
+
+        Return:
+            Tuple (archive, member, crc, size)
+        """
+        return (member['archive'], member['member'], member['crc'], member['size'])
+
+    def parse_members(self, regions, members=None, workers=None):
+        """
+        Parse CSV files of regions, every archive is opened only once
+
+        Arguments:
+            regions List of regions to be parsed
+            members Dictionary region : list of members from archive_members
+                    which should be parsed (default all members)
+            workers Number of processes used for parsing (None means serial)
+
+        Return:
+            Dictionary region : (dictionary from parse_region_data, list of parsed
+            members with their position in data - start and rows)
+        """
+        regions = list(regions)
+        if members is None:
+            members = self.archive_members(regions)
+
+        if workers is not None and workers > 1 and len(regions) > 1:
+            groups = [regions[x::workers] for x in range(min(workers, len(regions)))]
+            parsed = {}
+            with concurrent.futures.ProcessPoolExecutor(max_workers=len(groups)) as executor:
+                futures = [executor.submit(parse_members_worker, self.url, self.folder, self.cache_filename,
+                                           group, {region: members[region] for region in group})
+                           for group in groups]
+                for future in futures:
+                    parsed.update(future.result())
+            return {region: parsed[region] for region in regions}
+
+        wanted = {}
+        for region in regions:
+            for member in members[region]:
+                wanted.setdefault(member['archive'], []).append((region, member))
+
+        buffers = {region: [ColumnBuffer(dtype) for dtype in self.headers_types[:len(self.headers)]]
+                   for region in regions}
+        done = {region: [] for region in regions}
+        for archiv in sorted(wanted.keys()):
+            with zipfile.ZipFile(f"./{self.folder}/{archiv}", 'r') as zf:
+                for region, member in wanted[archiv]:
+                    start = buffers[region][0].size
+                    with zf.open(member['member'], 'r') as csvfile:
+                        for chunk in self.read_chunks(csvfile):
+                            for index, column in enumerate(chunk):
+                                buffers[region][index].append(self.clean_column(column))
+                    done[region].append(dict(member, start=start, rows=buffers[region][0].size - start))
+
+        for region in regions:
+            for index, buffer in enumerate(buffers[region]):
+                if buffer.missing != 0:
+                    buffer.prepend(self.read_column(done[region], index, buffer.missing))
+
+        result = {}
+        for region in regions:
+            stats = {header: buffers[region][index].finish() for index, header in enumerate(self.headers)}
+            stats['region'] = np.full(len(stats[self.headers[0]]), region)
+            result[region] = (stats, done[region])
 
         return result
 
-    def get_dict(self, regions=None):
+    def read_column(self, members, index, rows):
+        """
+        Read cleaned strings of one column again
+
+        Arguments:
+            members List of parsed members in order of parsing
+            index   Index of column
+            rows    Number of first rows to read
+
+        Return:
+            Numpy array of cleaned strings
+        """
+        parts = []
+        count = 0
+        for member in members:
+            if count >= rows:
+                break
+            with zipfile.ZipFile(f"./{self.folder}/{member['archive']}", 'r') as zf:
+                with zf.open(member['member'], 'r') as csvfile:
+                    for chunk in self.read_chunks(csvfile):
+                        parts.append(self.clean_column(chunk[index][:rows - count]))
+                        count += len(parts[-1])
+                        if count >= rows:
+                            break
+        return np.concatenate(parts) if parts != [] else np.zeros(0, dtype=np.str_)
+
+    def read_chunks(self, csvfile):
+        """
+        Read CSV file by chunks of chunk_rows rows
+
+        Arguments:
+            csvfile     Opened binary CSV file (cp1250)
+
+        Return:
+            Generator of 2D numpy arrays of strings, one row per column
+        """
+        reader = csv.reader(io.TextIOWrapper(csvfile, 'cp1250'), delimiter=';')
+        while True:
+            rows = list(itertools.islice(reader, self.chunk_rows))
+            if rows == []:
+                return
+            yield np.array(rows).T
+
+    def cache_path(self, region):
+        """
+        Get path to cache of region
+
+        Arguments:
+            region  Region code
+
+        Return:
+            Path to directory with columns of region
+        """
+        return f"./{self.folder}/{self.cache_filename.format(region)}"
+
+    def cache_key(self, region):
+        """
+        Get key of region in memory cache
+
+        Arguments:
+            region  Region code
+
+        Return:
+            Tuple (folder, cache_filename, region)
+        """
+        return (os.path.abspath(self.folder), self.cache_filename, region)
+
+    def save_region_cache(self, region, stats, members):
+        """
+        Save region data as columnar cache, one .npy file per column
+
+        Cache is written to temporary directory which is then renamed,
+        so incomplete cache is never read. If pyproj is installed, columns
+        x and y with coordinates d, e projected to EPSG:3857 are added.
+
+        Arguments:
+            region  Region code
+            stats   Dictionary from parse_region_data
+            members List of archive members the data were parsed from
+        """
+        path = self.cache_path(region)
+        tmp = path + '.tmp'
+        if os.path.exists(tmp):
+            shutil.rmtree(tmp)
+        os.mkdir(tmp)
+
+        # Souradnice v EPSG:3857 se spocitaji jednou pri ukladani
+        if projection.available() and 'x' not in stats:
+            stats = dict(stats)
+            stats['x'], stats['y'] = projection.project(stats['d'], stats['e'])
+
+        for column, values in stats.items():
+            np.save(f"{tmp}/{column}.npy", values)
+        meta = {'columns': list(stats.keys()), 'rows': len(stats['region']), 'members': members}
+        if 'x' in stats:
+            meta['projection'] = projection.VERSION
+        with open(f"{tmp}/meta.json", 'w') as fp:
+            json.dump(meta, fp, indent=1)
+
+        # Zbytek po preruseni predchozi vymeny by zablokoval prejmenovani
+        if os.path.exists(path + '.old'):
+            shutil.rmtree(path + '.old')
+        if os.path.exists(path):
+            os.rename(path, path + '.old')
+            os.rename(tmp, path)
+            shutil.rmtree(path + '.old')
+        else:
+            os.rename(tmp, path)
+
+    def load_region_meta(self, region):
+        """
+        Load description of columnar cache of region
+
+        Arguments:
+            region  Region code
+
+        Return:
+            Dictionary with columns, rows and members the cache was built from
+        """
+        with open(f"{self.cache_path(region)}/meta.json", 'r') as fp:
+            return json.load(fp)
+
+    def update_region_cache(self, region, kept, stats, members):
+        """
+        Replace changed part of region cache with newly parsed data
+
+        Arguments:
+            region  Region code
+            kept    Members from cache meta which did not change
+            stats   Dictionary with data parsed from new or changed members
+            members New or changed members as returned by parse_members
+        """
+        old = self.load_region_cache(region)
+        index = np.concatenate([np.arange(member['start'], member['start'] + member['rows'])
+                                for member in kept] + [np.zeros(0, dtype=np.int64)])
+        merged = {column: np.concatenate((self.encode_column(column, old[column][index]), stats[column]))
+                  for column in stats}
+
+        result_members = []
+        start = 0
+        for member in kept:
+            result_members.append(dict(member, start=start))
+            start += member['rows']
+        for member in members:
+            result_members.append(dict(member, start=start + member['start']))
+
+        self.save_region_cache(region, merged, result_members)
+
+    def project_region_cache(self, region):
+        """
+        Add or recompute projected columns x and y of existing cache of region
+
+        Arguments:
+            region  Region code
+        """
+        path = self.cache_path(region)
+        meta = self.load_region_meta(region)
+        stats = self.load_region_cache(region)
+        projected = dict(zip(projection.PROJECTED_COLUMNS, projection.project(stats['d'], stats['e'])))
+        for column, values in projected.items():
+            np.save(f"{path}/{column}.tmp.npy", values)
+            os.replace(f"{path}/{column}.tmp.npy", f"{path}/{column}.npy")
+
+        meta['columns'] += [column for column in projected if column not in meta['columns']]
+        meta['projection'] = projection.VERSION
+        with open(f"{path}/meta.json.tmp", 'w') as fp:
+            json.dump(meta, fp, indent=1)
+        os.replace(f"{path}/meta.json.tmp", f"{path}/meta.json")
+
+    def load_region_cache(self, region):
+        """
+        Open columnar cache of region
+
+        Columns are memory mapped, so only used parts of them are read from disk.
+
+        Arguments:
+            region  Region code
+
+        Return:
+            Dictionary column : read-only numpy memmap
+        """
+        path = self.cache_path(region)
+        meta = self.load_region_meta(region)
+        return {column: np.load(f"{path}/{column}.npy", mmap_mode='r') for column in meta['columns']}
+
+    def filter_mask(self, stats, where):
         """
-        Get cached files or call parse_region_data and cache it in cache_filename
+        Compute mask of rows matching all conditions
+
+        Arguments:
+            stats   Dictionary column : numpy array
+            where   Dictionary column : condition, condition is tuple (low, high)
+                    for inclusive range (bound can be None), list or set for
+                    membership and any other value for equality, values
+                    are compared in decoded form (dictionary encoded columns
+                    by their categories, not by codes)
+
+        Return:
+            Boolean numpy array or None if there are no conditions
+        """
+        mask = None
+        for column, condition in where.items():
+            values = stats[column]
+            if self.column_encoding(column, values.dtype) == 'category':
+                # Kody jsou v poradi pridani, podminka se vyhodnoti nad kategoriemi
+                part = self.filter_mask({column: self.categories(column)}, {column: condition})[values]
+            elif isinstance(condition, tuple):
+                low, high = condition
+                part = np.ones(len(values), dtype=bool)
+                if low is not None:
+                    part &= values >= self.encode_value(column, values.dtype, low)
+                if high is not None:
+                    part &= values <= self.encode_value(column, values.dtype, high)
+            elif isinstance(condition, (list, set)):
+                part = np.isin(values, [self.encode_value(column, values.dtype, value) for value in condition])
+            else:
+                part = values == self.encode_value(column, values.dtype, condition)
+            mask = part if mask is None else mask & part
+        return mask
+
+    @classmethod
+    def column_encoding(cls, column, dtype):
+        """
+        Get encoding of stored column
+
+        Arguments:
+            column  Name of column
+            dtype   Type of stored column
+
+        Return:
+            'category' for integer codes into categories, 'bytes' for fixed-width
+            ASCII bytes or None for column stored as it is
+        """
+        if column in cls.category_columns and dtype.kind in 'iu':
+            return 'category'
+        if dtype.kind == 'S':
+            return 'bytes'
+        return None
+
+    def categories(self, column):
+        """
+        Get categories of dictionary encoded column
+
+        Categories are shared by all regions in folder, new values are only
+        appended, so codes of already stored data stay valid.
+
+        Arguments:
+            column  Name of column from category_columns
+
+        Return:
+            Numpy array of strings, code of value is its index
+        """
+        if column == 'region':
+            return np.array(list(self.regions.keys()))
+
+        key = (os.path.abspath(self.folder), column)
+        if key not in self.shared_categories:
+            path = f"./{self.folder}/{self.categories_folder}/{column}.npy"
+            self.shared_categories[key] = np.load(path) if os.path.exists(path) else np.zeros(0, dtype='U1')
+        return self.shared_categories[key]
+
+    def add_categories(self, column, values):
+        """
+        Append new values to categories of column and save them
+
+        Categories are loaded again under lock of column, so values appended
+        by other processes in the meantime are kept and not added twice.
+
+        Arguments:
+            column  Name of column from category_columns
+            values  Numpy array of values which are not in categories yet
+        """
+        folder = f"./{self.folder}/{self.categories_folder}"
+        os.makedirs(folder, exist_ok=True)
+        key = (os.path.abspath(self.folder), column)
+        with open(f"{folder}/{column}.lock", 'w') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            self.shared_categories.pop(key, None)
+            categories = self.categories(column)
+            values = values[~np.isin(values, categories)]
+            if len(values) != 0:
+                categories = np.concatenate((categories, values))
+                np.save(f"{folder}/{column}.tmp.npy", categories)
+                os.replace(f"{folder}/{column}.tmp.npy", f"{folder}/{column}.npy")
+                self.shared_categories[key] = categories
+
+    def encode_column(self, column, values):
+        """
+        Convert string column to compact representation
+
+        Columns from category_columns are replaced by smallest integer codes,
+        other string columns by ASCII bytes if possible.
+
+        Arguments:
+            column  Name of column
+            values  Numpy array
+
+        Return:
+            Encoded numpy array
+        """
+        if values.dtype.kind != 'U':
+            return values
+
+        if column not in self.category_columns:
+            try:
+                return values.astype(np.bytes_)
+            except UnicodeEncodeError:
+                return values
+
+        uniques, inverse = np.unique(values, return_inverse=True)
+        categories = self.categories(column)
+        new = uniques[~np.isin(uniques, categories)]
+        if len(new) != 0:
+            self.add_categories(column, new)
+            categories = self.categories(column)
+
+        order = np.argsort(categories)
+        codes = order[np.searchsorted(categories, uniques, sorter=order)]
+        for dtype in (np.int8, np.int16, np.int32):
+            if len(categories) <= np.iinfo(dtype).max:
+                break
+        return codes[inverse].astype(dtype)
+
+    def encode_stats(self, stats):
+        """
+        Encode all columns of region data
+
+        Arguments:
+            stats   Dictionary from parse_region_data
+
+        Return:
+            Dictionary with encoded columns
+        """
+        return {column: self.encode_column(column, values) for column, values in stats.items()}
+
+    def encode_value(self, column, dtype, value):
+        """
+        Convert value from condition to representation of stored column
+
+        Arguments:
+            column  Name of column
+            dtype   Type of stored column
+            value   Value in decoded form
+
+        Return:
+            Value comparable with stored column, dictionary encoded columns
+            are compared through their categories (see filter_mask)
+        """
+        if dtype.kind in 'SU':
+            # Bez sirky typu, delsi hodnota se nesmi oriznout na sirku sloupce
+            return np.asarray(value, dtype=dtype.kind)
+        return np.asarray(value, dtype=dtype)
+
+    def decoded_dtype(self, column, dtype):
+        """
+        Get type of column after decoding
+
+        Arguments:
+            column  Name of column
+            dtype   Type of stored column
+
+        Return:
+            Numpy dtype
+        """
+        encoding = self.column_encoding(column, dtype)
+        if encoding == 'category':
+            return self.categories(column).dtype
+        if encoding == 'bytes':
+            return np.dtype(f"U{dtype.itemsize}")
+        return dtype
+
+    def decode_column(self, column, values):
+        """
+        Convert stored column back to strings
+
+        Arguments:
+            column  Name of column
+            values  Stored numpy array
+
+        Return:
+            Decoded numpy array
+        """
+        encoding = self.column_encoding(column, values.dtype)
+        if encoding == 'category':
+            return self.categories(column)[values]
+        if encoding == 'bytes':
+            return values.astype(np.str_)
+        return values
+
+    def sync_caches(self, regions, workers=None):
+        """
+        Create missing region caches and update caches of changed archives
+
+        Region cache is checked against archives only once per process (see
+        shared_validated), again only after archives were downloaded.
+
+        Arguments:
+            regions List of region codes
+            workers Number of processes used for parsing of uncached regions
+        """
+        files = os.listdir(f"./{self.folder}")
+        regions = [region for region in regions if self.cache_key(region) not in self.shared_validated
+                   or self.cache_filename.format(region) not in files]
+        if regions == []:
+            return
+
+        # Chybejici kraje se zpracuji najednou, kazdy archiv se otevre jen jednou
+        if any(self.cache_filename.format(region) not in files for region in regions):
+            self.ensure_data()
+        current = self.archive_members(regions)
+        archives = {archiv for archiv in os.listdir(f"./{self.folder}") if archiv.endswith('.zip')}
+
+        # Z cache se zahodi jen soubory, jejichz archiv existuje a zmenil se,
+        # data smazanych archivu zustanou, zpracuji se jen nove a zmenene CSV
+        kept = {}
+        changed = {}
+        unprojected = []
+        for region in regions:
+            meta = self.load_region_meta(region) if self.cache_filename.format(region) in files else {}
+            if 'members' in meta:
+                cached = meta['members']
+                key = {self.member_key(member) for member in current[region]}
+                old_key = {self.member_key(member) for member in cached}
+                kept[region] = [member for member in cached
+                                if member['archive'] not in archives or self.member_key(member) in key]
+                changed[region] = [member for member in current[region] if self.member_key(member) not in old_key]
+                if changed[region] == [] and len(kept[region]) == len(cached):
+                    del kept[region], changed[region]
+                    if projection.available() and meta.get('projection') != projection.VERSION:
+                        unprojected.append(region)
+            else:
+                changed[region] = current[region]
+
+        parsed = self.parse_members(changed.keys(), changed, workers) if changed != {} else {}
+        for region, (stats, members) in parsed.items():
+            self.cache.pop(self.cache_key(region))
+            stats = self.encode_stats(stats)
+            if region in kept:
+                self.update_region_cache(region, kept[region], stats, members)
+            else:
+                self.save_region_cache(region, stats, members)
+        for region in unprojected:
+            self.cache.pop(self.cache_key(region))
+            self.project_region_cache(region)
+        self.shared_validated.update(self.cache_key(region) for region in regions)
+
+    def get_dict(self, regions=None, workers=None, columns=None, where=None, decode=True):
+        """
+        Get cached files or call parse_regions_data and cache it in cache_filename
 
         Arguments:
             regions From which regions to get data (must be a list)
+            workers Number of processes used for parsing of uncached regions
+            columns Which columns to return (default all headers and region),
+                    x and y are coordinates in EPSG:3857 if pyproj is installed
+            where   Conditions rows must match, see filter_mask,
+                    e.g. {'p2a': ('2016-01-01', '2020-12-31'), 'p36': 1}
+            decode  If False, dictionary encoded columns are returned as codes
+                    (see categories) and other string columns as bytes
 
         Return:
             Function return dictionary where headers are keys and values are numpy
             arrays with data
         """
-        result = {self.headers[x]: np.zeros(0, dtype=self.headers_types[x]) for x, value in enumerate(self.headers)}
-        result['region'] = np.zeros(0, dtype='U50')
+        if columns is None:
+            columns = self.headers + ['region']
+        types = dict(zip(self.headers, self.headers_types))
+        types['region'] = 'U50'
+        for column in projection.PROJECTED_COLUMNS:
+            types[column] = np.float64
 
         if regions is None:
             regions = self.regions.keys()
+        regions = list(regions)
+
+        self.sync_caches(regions, workers)
+
+        # Nejdrive se zjisti velikost vysledku, pole se pak alokuji jen jednou
+        sources = []
         for region in regions:
-            if region in self.cache.keys():
-                stats = self.cache[region]
-            elif self.cache_filename.format(region) in os.listdir(f"./{self.folder}"):
-                with gzip.open(f'./{self.folder}/{self.cache_filename.format(region)}', 'rb') as cache_file:
-                    stats = pickle.load(cache_file)
-                self.cache[region] = stats
-            else:
-                stats = self.parse_region_data(region)
-                with gzip.open(f'./{self.folder}/{self.cache_filename.format(region)}', 'wb', compresslevel=5) as cache_file:
-                    pickle.dump(stats, cache_file)
+            # Ze souboru se ctou jen sloupce potrebne pro podminky a vysledek,
+            # nactene sloupce zustanou v LRU cache
+            stats = self.cache.get(self.cache_key(region)) or {}
+            missing = [column for column in dict.fromkeys(list(columns) + list(where or {})) if column not in stats]
+            if missing != []:
+                mapped = self.load_region_cache(region)
+                stats = {**stats, **{column: np.array(mapped[column]) for column in missing}}
+                self.cache.put(self.cache_key(region), stats)
+
+            mask = self.filter_mask(stats, where) if where else None
+            rows = len(stats[columns[0]]) if mask is None else int(np.count_nonzero(mask))
+            sources.append((stats, mask, rows))
 
-            for header in self.headers:
-                result[header] = np.concatenate((result[header], stats[header]))
+        total = sum(rows for stats, mask, rows in sources)
+        result = {}
+        for column in columns:
+            dtypes = [stats[column].dtype for stats, mask, rows in sources]
+            if decode:
+                dtype = np.result_type(np.dtype(types[column]), *[self.decoded_dtype(column, x) for x in dtypes])
+            else:
+                dtype = np.result_type(*dtypes) if dtypes != [] else np.dtype(types[column])
+            result[column] = np.empty(total, dtype=dtype)
 
-            result['region'] = np.concatenate((result['region'], stats[region]))
+            start = 0
+            for stats, mask, rows in sources:
+                out = result[column][start:start + rows]
+                if decode and self.column_encoding(column, stats[column].dtype) is not None:
+                    out[...] = self.decode_column(column, stats[column] if mask is None else stats[column][mask])
+                elif mask is None:
+                    out[...] = stats[column]
+                elif stats[column].dtype == dtype:
+                    np.compress(mask, stats[column], out=out)
+                else:
+                    out[...] = stats[column][mask]
+                start += rows
 
         return result
 
+    def iter_chunks(self, regions=None, workers=None, columns=None, where=None, decode=True, block_rows=None):
+        """
+        Iterate over cached data of regions by blocks of rows
+
+        Only one block of used columns is in memory at a time, so memory
+        does not depend on number of rows, results of blocks can be merged
+        by caller (e.g. aggregate.count_chunks).
+
+        Arguments:
+            regions     From which regions to get data (default all)
+            workers     Number of processes used for parsing of uncached regions
+            columns     Which columns to return (default all headers and region)
+            where       Conditions rows must match, see filter_mask
+            decode      If False, columns are returned as stored, see get_dict
+            block_rows  Number of rows of block (default block_rows)
+
+        Return:
+            Generator of dictionaries column : numpy array, one per block with
+            at least one matching row
+        """
+        if columns is None:
+            columns = self.headers + ['region']
+        if regions is None:
+            regions = self.regions.keys()
+        regions = list(regions)
+        block_rows = self.block_rows if block_rows is None else block_rows
+
+        self.sync_caches(regions, workers)
+        for region in regions:
+            # Sloupce, ktere nejsou v LRU cache, se ctou z pametove mapovanych
+            # souboru po blocich a do cache se nevkladaji
+            stats = {**self.load_region_cache(region), **(self.cache.get(self.cache_key(region)) or {})}
+            for start in range(0, len(stats[columns[0]]), block_rows):
+                block = {column: stats[column][start:start + block_rows] for column in set(columns) | set(where or {})}
+                mask = self.filter_mask(block, where) if where else None
+                if mask is not None and not mask.any():
+                    continue
+                chunk = {}
+                for column in columns:
+                    values = np.asarray(block[column]) if mask is None else block[column][mask]
+                    chunk[column] = self.decode_column(column, values) if decode else values
+                yield chunk
+
+
+def parse_members_worker(url, folder, cache_filename, regions, members):
+    """
+    Parse regions in worker process
+
+    Arguments:
+        url, folder, cache_filename     Arguments of DataDownloader
+        regions                         List of regions to be parsed
+        members                         Members to be parsed, see parse_members
+
+    Return:
+        Function return result of parse_members
+    """
+    return DataDownloader(url, folder, cache_filename).parse_members(regions, members)
+
 
 if __name__ == '__main__':
     data = DataDownloader().get_dict(['PHA', 'STC', 'JHC'])
@@ -1,76 +1,129 @@
 #!/usr/bin/python3.8
 # coding=utf-8
 import pandas as pd
-import geopandas
 import matplotlib.pyplot as plt
-import contextily as ctx
-import sklearn.cluster
 import numpy as np
 
+from aggregate import get_date_index, select_dates
+from cluster import cluster_groups
+from projection import project
+from spatial import crop, crop_rows, rasterize
+from tiles import TileCache, add_basemap
 
-def get_year(gdf: geopandas.GeoDataFrame, year):
+# Nejmensi sirka a vyska rastru v metrech (jeden bod, body na primce)
+DENSITY_MARGIN = 500.0
+
+
+def get_year(df: pd.DataFrame, year):
     """
     Get data for specified year
 
     Arugments:
-        gdf - dataframe with data
+        df - dataframe with data
         year - year for data extraction
     """
-    gdf = gdf[(gdf['p2a'] >= pd.to_datetime(f'{year}-1-1'))
-              & (gdf['p2a'] <= pd.to_datetime(f'{year}-12-31'))]
-    return gdf
+    return select_dates(df, f'{year}-1-1', f'{year}-12-31', column='p2a')
 
 
-def make_geo(df: pd.DataFrame) -> geopandas.GeoDataFrame:
+def make_geo(df: pd.DataFrame) -> pd.DataFrame:
     """
-    Convert DataFrame to GeoDataFrame
+    Prepare data for geo plots with coordinates x, y in EPSG:3857
+
+    Coordinates are taken from columns x, y (columnar cache of DataDownloader)
+    or projected from d, e (EPSG:5514) with batched transform, no geometry
+    objects are created. Rows are sorted by date and date index is built
+    once for the dataset.
 
     Arguments:
         df - DataFrame to be converted
     """
     df['p2a'] = pd.to_datetime(df['p2a'])
-    df = df.dropna(subset=['d', 'e'])
-    gdf = geopandas.GeoDataFrame(df, geometry=geopandas.points_from_xy(df['d'], df['e']),
-                                 crs="EPSG:5514")
-    return gdf
-
-
-def plot_geo(gdf: geopandas.GeoDataFrame, fig_location: str = None,
-             show_figure: bool = False):
+    if 'x' not in df or 'y' not in df:
+        df['x'], df['y'] = project(df['d'].to_numpy(), df['e'].to_numpy())
+    # Data serazena podle data, vyber roku je pak souvisly usek radku
+    df = df.dropna(subset=['x', 'y']).sort_values('p2a', kind='stable')
+    get_date_index(df, 'p2a')
+    return df
+
+
+def plot_geo(df: pd.DataFrame, fig_location: str = None,
+             show_figure: bool = False, tiles: TileCache = None,
+             viewport: tuple = None, mode: str = 'points',
+             bins: int = 400, sigma: float = 1.5):
     """
     Plot graph for each year with location of accident on highway
     or first class road
 
     Arguments:
-        gdf - GeoDataFrame with data
+        df - DataFrame from make_geo
         fig_location - where to store graphs
         show_figure - whether to show plot or not
+        tiles - cache of basemap tiles (default TileCache())
+        viewport - plotted area (xmin, xmax, ymin, ymax) in EPSG:3857
+            (default whole region)
+        mode - 'points' draws every accident, 'density' draws raster
+            of accident counts (time does not depend on number of accidents)
+        bins - number of raster cells along longer side (density mode)
+        sigma - Gaussian smoothing of raster in cells, 0 is none (density mode)
     """
-    gdf = gdf[gdf['region'].isin(['JHM'])].to_crs(epsg=3857)
-
-    y_2018 = get_year(gdf, 2018)
-    y_2019 = get_year(gdf, 2019)
-    y_2020 = get_year(gdf, 2020)
+    if mode not in ('points', 'density'):
+        raise ValueError(f"unknown mode {mode}")
+    # Indexy dat a roku se stavi nad celym datasetem jen jednou, vybery jsou pozice radku
+    dates = get_date_index(df, 'p2a')
+    keep = df['region'].isin(['JHM']).to_numpy()
+    if viewport is not None:
+        inside = np.zeros(len(df), dtype=bool)
+        inside[crop_rows(df, viewport)] = True
+        keep &= inside
+    x, y, road_class = df['x'].to_numpy(), df['y'].to_numpy(), df['p36'].to_numpy()
+
+    # Vsechny rastry maji stejny rozsah i mrizku, aby byly srovnatelne
+    extent = viewport
+    if mode == 'density' and extent is None and keep.any():
+        extent = (x[keep].min(), x[keep].max(), y[keep].min(), y[keep].max())
+        # Jeden bod nebo body na primce, rozsah se rozsiri, aby mel plochu
+        if extent[1] - extent[0] < DENSITY_MARGIN:
+            extent = (extent[0] - DENSITY_MARGIN, extent[1] + DENSITY_MARGIN) + extent[2:]
+        if extent[3] - extent[2] < DENSITY_MARGIN:
+            extent = extent[:2] + (extent[2] - DENSITY_MARGIN, extent[3] + DENSITY_MARGIN)
+    if mode == 'density' and extent is not None:
+        width, height = extent[1] - extent[0], extent[3] - extent[2]
+        scale = bins / max(width, height, 1e-9)
+        shape = (max(int(round(height * scale)), 1), max(int(round(width * scale)), 1))
 
     fig, ax = plt.subplots(3, 2, figsize=(12, 15), sharex=True, sharey=True)
     fig.suptitle('Nehody v JHM kraji na dálnici a na silnicích 1. třídy v jednotlivých letech', fontsize=20)
 
-    d1 = y_2018[y_2018['p36'] == 0].plot(ax=ax[0][0], markersize=4, label="Dálnice", color='tab:green')
-    d1.set_title('JHM: dálnice (2018)')
-    s1 = y_2018[y_2018['p36'] == 1].plot(ax=ax[0][1], markersize=4, label="Silnice 1. třídy", color='tab:red')
-    s1.set_title('JHM: silnice 1. třídy (2018)')
-    d2 = y_2019[y_2019['p36'] == 0].plot(ax=ax[1][0], markersize=4, label="Dálnice", color='tab:green')
-    d2.set_title('JHM: dálnice (2019)')
-    s2 = y_2019[y_2019['p36'] == 1].plot(ax=ax[1][1], markersize=4, label="Silnice 1. třídy", color='tab:red')
-    s2.set_title('JHM: silnice 1. třídy (2019)')
-    d3 = y_2020[y_2020['p36'] == 0].plot(ax=ax[2][0], markersize=4, label="Dálnice", color='tab:green')
-    d3.set_title('JHM: dálnice (2020)')
-    s3 = y_2020[y_2020['p36'] == 1].plot(ax=ax[2][1], markersize=4, label="Silnice 1. třídy", color='tab:red')
-    s3.set_title('JHM: silnice 1. třídy (2020)')
-
+    roads = [(0, "Dálnice", 'tab:green', 'dálnice', 'Greens'),
+             (1, "Silnice 1. třídy", 'tab:red', 'silnice 1. třídy', 'Reds')]
+    panels = []
+    for row, year in enumerate([2018, 2019, 2020]):
+        rows = np.arange(len(df))[dates.rows(f'{year}-1-1', f'{year}-12-31')]
+        rows = rows[keep[rows]]
+        for col, (p36, label, color, title, cmap) in enumerate(roads):
+            panels.append((ax[row][col], year, rows[road_class[rows] == p36], label, color, title, cmap))
+
+    # Rastry maji spolecnou barevnou skalu, barvy panelu jsou srovnatelne
+    if mode == 'density' and extent is not None:
+        rasters = [rasterize(x[road], y[road], extent, shape, sigma) for _, _, road, *_ in panels]
+        vmax = max(raster.max() for raster in rasters)
+
+    for index, (axis, year, road, label, color, title, cmap) in enumerate(panels):
+        if mode == 'points':
+            axis.scatter(x[road], y[road], s=4, label=label, color=color)
+        elif extent is not None:
+            # Prazdna pole jsou pruhledna, aby byl videt podklad
+            raster = np.ma.masked_less_equal(rasters[index], vmax * 1e-3)
+            axis.imshow(raster, extent=extent, origin='upper', cmap=cmap, alpha=0.8, vmin=0, vmax=vmax,
+                        interpolation='nearest', zorder=2)
+        axis.set_aspect('equal')
+        axis.set_title(f'JHM: {title} ({year})')
+
+    # Osy sdili rozsah, dlazdice se nactou jednou a obraz se pouzije pro vsechny
     for ax in ax.ravel():
-        ctx.add_basemap(ax, crs=gdf.crs.to_string(),
-                        source=ctx.providers.Stamen.TonerLite)
+        if viewport is not None:
+            ax.axis(viewport)
+        add_basemap(ax, tiles)
         ax.set_axis_off()
 
     if fig_location:
@@ -80,37 +133,54 @@ def plot_geo(gdf: geopandas.GeoDataFrame, fig_location: str = None,
         plt.show()
 
 
-def plot_cluster(gdf: geopandas.GeoDataFrame, fig_location: str = None,
-                 show_figure: bool = False):
+def plot_cluster(df: pd.DataFrame, fig_location: str = None,
+                 show_figure: bool = False, tiles: TileCache = None,
+                 engine: str = 'kmeans', regions: list = None, roads: list = None,
+                 params: dict = None, viewport: tuple = None):
     """
     Plot graph with location of accidents on highway in clusters
 
     Arguments:
-        gdf - GeoDataFrame with data
+        df - DataFrame from make_geo
         fig_location - where to store graphs
         show_figure - whether to show plot or not
+        tiles - cache of basemap tiles (default TileCache())
+        engine - clustering engine from cluster.ENGINES
+        regions - clustered regions (default JHM)
+        roads - clustered road classes p36 (default first class roads)
+        params - parameters of engine (default 25 clusters for kmeans)
+        viewport - plotted area (xmin, xmax, ymin, ymax) in EPSG:3857,
+            only accidents inside are clustered (default whole regions)
     """
-    gdf = gdf[gdf['region'].isin(['JHM'])]
-    gdf = gdf[gdf['p36'] == 1]
-
-    gdf_c = gdf.copy()
-    gdf_c = gdf_c.set_geometry(gdf_c.centroid).to_crs(epsg=3857)
-    coords = np.dstack([gdf_c.geometry.x, gdf_c.geometry.y]).reshape(-1, 2)
-
-    db = sklearn.cluster.MiniBatchKMeans(n_clusters=25).fit(coords)
-    gdf_plot = gdf_c.copy()
-    gdf_plot["cluster"] = db.labels_
-    gdf_plot = gdf_plot.dissolve(by="cluster", aggfunc={"p1": "count"}
-                                 ).rename(columns=dict(p1="count"))
+    regions = ['JHM'] if regions is None else regions
+    roads = [1] if roads is None else roads
+    if params is None:
+        params = {'n_clusters': 25} if engine == 'kmeans' else {}
+
+    if viewport is not None:
+        df = crop(df, viewport)
+    df = df[df['region'].isin(regions) & df['p36'].isin(roads)]
+    # Kazdy kraj a druh silnice ma vlastni shluky, prirazeni se uklada
+    labels = cluster_groups(df, engine, **params)
+    clustered = labels >= 0
+    x, y = df['x'].to_numpy(), df['y'].to_numpy()
 
     plt.figure(figsize=(10, 10))
-    plt.suptitle('Nehody v Jihomoravském kraji na silnicích 1. třídy')
+    if regions == ['JHM'] and roads == [1]:
+        plt.suptitle('Nehody v Jihomoravském kraji na silnicích 1. třídy')
+    else:
+        plt.suptitle(f"Shluky nehod v krajích {', '.join(regions)} (p36: {', '.join(map(str, roads))})")
     ax = plt.gca()
 
-    gdf_plot.plot(ax=ax, markersize=8, column="count", legend=True, alpha=0.6,
-                  legend_kwds={'location': 'bottom',
-                               'label': 'Počet nehod v úseku', 'pad': 0.01})
-    ctx.add_basemap(ax, crs="epsg:3857", source=ctx.providers.Stamen.TonerLite)
+    ax.scatter(x[~clustered], y[~clustered], s=2, color='tab:gray', alpha=0.4)
+    # Kazdy bod ma barvu podle poctu nehod ve svem shluku
+    counts = np.bincount(labels[clustered])[labels[clustered]]
+    points = ax.scatter(x[clustered], y[clustered], s=8, c=counts, alpha=0.6)
+    ax.set_aspect('equal')
+    if viewport is not None:
+        ax.axis(viewport)
+    plt.colorbar(points, ax=ax, location='bottom', label='Počet nehod v úseku', pad=0.01)
+    add_basemap(ax, tiles)
 
     ax.set_aspect("auto")
     plt.axis("off")
@@ -125,6 +195,6 @@ def plot_cluster(gdf: geopandas.GeoDataFrame, fig_location: str = None,
 
 if __name__ == "__main__":
     # zde muzete delat libovolne modifikace
-    gdf = make_geo(pd.read_pickle("accidents.pkl.gz"))
-    plot_geo(gdf, "geo1.png", False)
-    plot_cluster(gdf, "geo2.png", False)
+    df = make_geo(pd.read_pickle("accidents.pkl.gz"))
+    plot_geo(df, "geo1.png", False)
+    plot_cluster(df, "geo2.png", False)
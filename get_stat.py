@@ -12,6 +12,8 @@ import os
 # povolene jsou pouze zakladni knihovny (os, sys) a knihovny numpy, matplotlib a argparse
 
 from download import DataDownloader
+from aggregate import crosstab
+from dataset import AccidentDataset
 
 
 def plot_stat(data_source, fig_location=None, show_figure=False):
@@ -19,30 +21,26 @@ def plot_stat(data_source, fig_location=None, show_figure=False):
     Generate figures form given data set
 
     Arguments:
-        data_source     Data source
+        data_source     Data source, dictionary from get_dict or AccidentDataset
+                        (only columns region and p24 are read)
         fig_location    If set save figure in that location
         show_figure     If set, show figure
     """
-    regions = data_source['region']
-    reg_dict = {}
-    for region in set(regions):
-        indx = np.where(data_source['region'] == region)
-        none = np.sum(data_source['p24'][indx] == 0)
-        yellow = np.sum(data_source['p24'][indx] == 1)
-        out_order = np.sum(data_source['p24'][indx] == 2)
-        sign = np.sum(data_source['p24'][indx] == 3)
-        sign_transport = np.sum(data_source['p24'][indx] == 4)
-        rules = np.sum(data_source['p24'][indx] == 5)
-
-        reg_dict[region] = np.array([yellow, out_order, sign, sign_transport, rules, none])
-
-    plot_regions = list(DataDownloader().regions.keys())
+    plot_regions = list(DataDownloader.regions.keys())
     plot_regions.sort()
     plot_yaxis = ['Preřušovana žluta', 'Semafor mimo provoz', 'Dopravními značky', 'Přenosné dopravní značky', 'Nevyznačena', 'Žádná úprava']
 
-    array = np.zeros((14, 6))
-    for indx, region in enumerate(plot_regions):
-        array[indx] = reg_dict[region]
+    if isinstance(data_source, AccidentDataset):
+        data_source = data_source.select('region', 'p24').collect()
+
+    # Kraje mohou byt i kody z get_dict(decode=False)
+    region_domain = plot_regions
+    if data_source['region'].dtype.kind in 'iu':
+        codes = list(DataDownloader.regions.keys())
+        region_domain = [codes.index(region) for region in plot_regions]
+
+    _, _, array = crosstab(data_source['region'], data_source['p24'], region_domain, [1, 2, 3, 4, 5, 0])
+    array = array.astype(np.float64)
 
     relative = 100 * (array / np.sum(array, axis=0))
     relative = np.transpose(relative)
@@ -96,5 +94,4 @@ if __name__ == '__main__':
     parser.add_argument('--show_figure', default=False, action='store_true')
     parser.add_argument('--fig_location', type=str)
     args = parser.parse_args()
-    data = DataDownloader().get_dict()
-    plot_stat(data, args.fig_location, args.show_figure)
+    plot_stat(AccidentDataset(decode=False), args.fig_location, args.show_figure)
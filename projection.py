@@ -0,0 +1,76 @@
+#!/usr/bin/env python3
+"""
+Projection of accident coordinates from S-JTSK to Web Mercator
+Author: Karel Norek, xnorek01
+"""
+# -*- coding: utf-8 -*-
+import numpy as np
+
+try:
+    import pyproj
+except ImportError:
+    pyproj = None
+
+# Souradnice d, e jsou v S-JTSK (EPSG:5514), grafy a dlazdice v EPSG:3857
+SOURCE_CRS = "EPSG:5514"
+TARGET_CRS = "EPSG:3857"
+PROJECTED_COLUMNS = ('x', 'y')
+CHUNK = 1 << 20
+# Prazdne souradnice uklada parser jako -1, v S-JTSK to neni platny bod
+MISSING = -1
+# Verze vypoctu x, y v cache, starsi cache se prepocitaji
+VERSION = 2
+
+_transformers = {}
+
+
+def available():
+    """
+    Check if projection can be computed (pyproj is installed)
+    """
+    return pyproj is not None
+
+
+def get_transformer(source=SOURCE_CRS, target=TARGET_CRS):
+    """
+    Get transformer between coordinate systems, created only once
+
+    Arguments:
+        source  Source CRS
+        target  Target CRS
+
+    Return:
+        pyproj.Transformer with x, y order of axes
+    """
+    if (source, target) not in _transformers:
+        _transformers[(source, target)] = pyproj.Transformer.from_crs(source, target, always_xy=True)
+    return _transformers[(source, target)]
+
+
+def project(d, e, source=SOURCE_CRS, target=TARGET_CRS):
+    """
+    Transform coordinates with one batched call per chunk
+
+    Arguments:
+        d, e    Numpy arrays with x and y in source CRS
+        source  Source CRS
+        target  Target CRS
+
+    Return:
+        Tuple (x, y) of float64 numpy arrays in target CRS, rows without
+        valid coordinates (not finite or MISSING) are NaN
+    """
+    d = np.asarray(d, dtype=np.float64)
+    e = np.asarray(e, dtype=np.float64)
+    x = np.full(len(d), np.nan)
+    y = np.full(len(d), np.nan)
+    transformer = get_transformer(source, target)
+
+    valid = np.flatnonzero(np.isfinite(d) & np.isfinite(e) & (d != MISSING) & (e != MISSING))
+    for start in range(0, len(valid), CHUNK):
+        rows = valid[start:start + CHUNK]
+        x[rows], y[rows] = transformer.transform(d[rows], e[rows])
+
+    x[~np.isfinite(x) | ~np.isfinite(y)] = np.nan
+    y[np.isnan(x)] = np.nan
+    return x, y
@@ -0,0 +1,211 @@
+#!/usr/bin/env python3
+"""
+Batch rendering of all figures from one loaded dataset
+Author: Karel Norek, xnorek01
+"""
+# -*- coding: utf-8 -*-
+import argparse
+import concurrent.futures
+import importlib
+import multiprocessing
+import os
+import sys
+import time
+
+import matplotlib
+matplotlib.use('Agg')
+from matplotlib import pyplot as plt  # noqa: E402
+
+from analysis import read_dataframe, convert_dataframe  # noqa: E402
+from aggregate import get_cube  # noqa: E402
+from tiles import TileCache  # noqa: E402
+
+# Obrazek : (pohled na data, modul, funkce), funkce maji parametry (df, fig_location)
+FIGURES = {
+    '01_roadtype': ('analysis', 'analysis', 'plot_roadtype'),
+    '02_animals': ('analysis', 'analysis', 'plot_animals'),
+    '03_conditions': ('analysis', 'analysis', 'plot_conditions'),
+    'geo1': ('geo', 'geo', 'plot_geo'),
+    'geo2': ('geo', 'geo', 'plot_cluster'),
+    'fig': ('raw', 'doc', 'police_plot'),
+}
+
+# Data procesu, pracovni procesy je dedi pri fork nebo nacitaji v init_worker
+_dataset = None
+
+
+class Dataset:
+    """
+    Dataset loaded once with views for modules created on first use
+
+    Views:
+        raw         Dataframe as stored in file (doc.py)
+        analysis    Converted dataframe with aggregate cube (analysis.py)
+        geo         Dataframe with projected coordinates (geo.py)
+    """
+
+    def __init__(self, filename):
+        """
+        Initialize dataset
+
+        Arguments:
+            filename    Name of file with data
+        """
+        self.filename = filename
+        self.views = {}
+
+    def get(self, view):
+        """
+        Get view of dataset, view is created only once
+
+        Arguments:
+            view    Name of view
+
+        Return:
+            DataFrame
+        """
+        if view not in self.views:
+            if view == 'raw':
+                self.views[view] = read_dataframe(self.filename)
+            elif view == 'analysis':
+                df = convert_dataframe(self.get('raw').copy())
+                get_cube(df)
+                self.views[view] = df
+            elif view == 'geo':
+                self.views[view] = importlib.import_module('geo').make_geo(self.get('raw').copy())
+            else:
+                raise ValueError(f"unknown view {view}")
+        return self.views[view]
+
+
+def render_figure(dataset, name, output):
+    """
+    Render one figure with default matplotlib settings
+
+    Arguments:
+        dataset     Dataset
+        name        Name of figure from FIGURES
+        output      Folder for figures
+
+    Return:
+        Tuple (name, wall time in seconds, path)
+    """
+    view, module, function = FIGURES[name]
+    plot = getattr(importlib.import_module(module), function)
+    df = dataset.get(view)
+    path = os.path.join(output, f"{name}.png")
+
+    start = time.perf_counter()
+    # Styly a palety nastavene funkcemi se neprenesou do dalsich obrazku
+    with plt.rc_context():
+        plot(df, path)
+    plt.close('all')
+    return name, time.perf_counter() - start, path
+
+
+def init_worker(filename, views, tiles):
+    """
+    Load dataset in worker process which did not inherit it
+
+    Arguments:
+        filename    Name of file with data
+        views       Views to prepare
+        tiles       Tuple (folder, offline) of TileCache settings
+    """
+    global _dataset
+    TileCache.folder, TileCache.offline = tiles
+    _dataset = Dataset(filename)
+    for view in views:
+        _dataset.get(view)
+
+
+def render_worker(name, output):
+    """
+    Render figure from dataset of worker process
+
+    Arguments:
+        name        Name of figure
+        output      Folder for figures
+
+    Return:
+        See render_figure
+    """
+    return render_figure(_dataset, name, output)
+
+
+def render(filename, names, output='.', workers=1):
+    """
+    Load dataset once and render figures, report wall time of each figure
+
+    Arguments:
+        filename    Name of file with data
+        names       Names of figures from FIGURES
+        output      Folder for figures
+        workers     Number of processes (1 renders in this process)
+
+    Return:
+        True if all figures were rendered
+    """
+    global _dataset
+    views = list(dict.fromkeys(FIGURES[name][0] for name in names))
+    os.makedirs(output, exist_ok=True)
+
+    ok = True
+    start = time.perf_counter()
+    _dataset = Dataset(filename)
+    for view in views:
+        try:
+            _dataset.get(view)
+        except Exception as error:
+            ok = False
+            print(f"{view:<15}   failed  {type(error).__name__}: {error}")
+            names = [name for name in names if FIGURES[name][0] != view]
+    print(f"{'load':<15} {time.perf_counter() - start:8.2f} s  views={','.join(_dataset.views)}")
+
+    def report(name, future):
+        nonlocal ok
+        try:
+            name, elapsed, path = future()
+            print(f"{name:<15} {elapsed:8.2f} s  {path}")
+        except Exception as error:
+            ok = False
+            print(f"{name:<15}   failed  {type(error).__name__}: {error}")
+
+    if workers <= 1:
+        for name in names:
+            report(name, lambda: render_figure(_dataset, name, output))
+    else:
+        # Pri fork pracovni procesy sdili nactena data, jinak si je nactou samy
+        if 'fork' in multiprocessing.get_all_start_methods():
+            context, initializer, initargs = multiprocessing.get_context('fork'), None, ()
+        else:
+            context, initializer, initargs = multiprocessing.get_context(), init_worker, \
+                (filename, list(_dataset.views), (TileCache.folder, TileCache.offline))
+        with concurrent.futures.ProcessPoolExecutor(workers, mp_context=context, initializer=initializer,
+                                                    initargs=initargs) as executor:
+            futures = {executor.submit(render_worker, name, output): name for name in names}
+            for future in concurrent.futures.as_completed(futures):
+                report(futures[future], future.result)
+
+    print(f"{'total':<15} {time.perf_counter() - start:8.2f} s")
+    return ok
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--data', type=str, default='accidents.pkl.gz')
+    parser.add_argument('--output', type=str, default='.')
+    parser.add_argument('--workers', type=int, default=1,
+                        help='number of processes rendering figures')
+    parser.add_argument('--offline', default=False, action='store_true',
+                        help='use only cached basemap tiles')
+    parser.add_argument('--tiles', type=str, default=TileCache.folder,
+                        help='folder with cached basemap tiles')
+    parser.add_argument('--figures', type=str, nargs='+', choices=list(FIGURES), default=list(FIGURES),
+                        help='figures to render')
+    args = parser.parse_args()
+    # Nastaveni dlazdic pro vsechny obrazky, pracovni procesy ho dedi pri fork
+    TileCache.folder, TileCache.offline = args.tiles, args.offline
+    if not os.path.exists(args.data):
+        parser.error(f"file {args.data} does not exist")
+    sys.exit(0 if render(args.data, args.figures, args.output, args.workers) else 1)
@@ -0,0 +1,321 @@
+#!/usr/bin/env python3
+"""
+Spatial grid index of projected accident coordinates
+Author: Karel Norek, xnorek01
+"""
+# -*- coding: utf-8 -*-
+import os
+import weakref
+
+import numpy as np
+
+# Nejvetsi pocet poli mrizky, pri vetsim rozsahu dat se pole zvetsi
+MAX_CELLS = 1 << 22
+
+_indexes = {}
+_region_indexes = {}
+
+
+class GridIndex:
+    """
+    Uniform grid over points, points of every cell are stored together
+
+    Points are sorted by cell (column of cells x, then y), so bounding box
+    query reads one contiguous range of sorted points per column of cells
+    and filters only points of border cells.
+
+    Attributes:
+        low     Tuple (x, y) of corner of grid
+        cell    Size of cell in metres
+        shape   Tuple (columns, rows) of cells
+        starts  Position of first point of every cell in sorted points
+                (length columns * rows + 1)
+        order   Original positions of sorted points
+        xs, ys  Coordinates of sorted points
+    """
+
+    def __init__(self, low, cell, shape, starts, order, xs, ys):
+        """
+        Initialize index
+
+        Arguments:
+            low, cell, shape, starts, order, xs, ys     See attributes
+        """
+        self.low = low
+        self.cell = cell
+        self.shape = shape
+        self.starts = starts
+        self.order = order
+        self.xs = xs
+        self.ys = ys
+
+    @classmethod
+    def build(cls, x, y, cell=1000.0):
+        """
+        Build index, points without valid coordinates are left out
+
+        Arguments:
+            x, y    Numpy arrays with coordinates in EPSG:3857
+            cell    Size of cell in metres
+
+        Return:
+            GridIndex
+        """
+        x = np.asarray(x, dtype=np.float64)
+        y = np.asarray(y, dtype=np.float64)
+        rows = np.flatnonzero(np.isfinite(x) & np.isfinite(y))
+        if len(rows) == 0:
+            return cls((0.0, 0.0), cell, (1, 1), np.zeros(2, dtype=np.int64), rows,
+                       np.zeros(0), np.zeros(0))
+
+        low = (float(x[rows].min()), float(y[rows].min()))
+        width, height = float(x[rows].max()) - low[0], float(y[rows].max()) - low[1]
+        cell = max(cell, np.sqrt(width * height / MAX_CELLS), max(width, height) / MAX_CELLS)
+        shape = (int(width // cell) + 1, int(height // cell) + 1)
+
+        cx = ((x[rows] - low[0]) // cell).astype(np.int64)
+        cy = ((y[rows] - low[1]) // cell).astype(np.int64)
+        keys = cx * shape[1] + cy
+        sorted_rows = np.argsort(keys, kind='stable')
+        order = rows[sorted_rows]
+        starts = np.zeros(shape[0] * shape[1] + 1, dtype=np.int64)
+        np.cumsum(np.bincount(keys, minlength=shape[0] * shape[1]), out=starts[1:])
+        return cls(low, float(cell), shape, starts, order, x[order], y[order])
+
+    def save(self, path):
+        """
+        Save index to .npz file
+
+        Arguments:
+            path    Path to file
+        """
+        np.savez(path, low=np.array(self.low), cell=np.array(self.cell), shape=np.array(self.shape),
+                 starts=self.starts, order=self.order, xs=self.xs, ys=self.ys)
+
+    @classmethod
+    def load(cls, path):
+        """
+        Load index from .npz file
+
+        Arguments:
+            path    Path to file
+
+        Return:
+            GridIndex
+        """
+        with np.load(path) as data:
+            return cls(tuple(data['low']), float(data['cell']), tuple(int(n) for n in data['shape']),
+                       data['starts'], data['order'], data['xs'], data['ys'])
+
+    def candidates(self, xmin, xmax, ymin, ymax):
+        """
+        Get positions of sorted points in cells touching bounding box
+
+        Arguments:
+            xmin, xmax, ymin, ymax  Bounding box in EPSG:3857
+
+        Return:
+            Numpy array of positions in sorted points
+        """
+        columns, rows = self.shape
+        cx0, cx1 = ((np.array([xmin, xmax]) - self.low[0]) // self.cell).astype(np.int64)
+        cy0, cy1 = ((np.array([ymin, ymax]) - self.low[1]) // self.cell).astype(np.int64)
+        if cx1 < 0 or cy1 < 0 or cx0 >= columns or cy0 >= rows or cx0 > cx1 or cy0 > cy1:
+            return np.zeros(0, dtype=np.int64)
+        cx0, cy0 = max(cx0, 0), max(cy0, 0)
+        cx1, cy1 = min(cx1, columns - 1), min(cy1, rows - 1)
+
+        # Pro kazdy sloupec poli je to jeden souvisly usek serazenych bodu
+        column_keys = np.arange(cx0, cx1 + 1) * rows
+        first = self.starts[column_keys + cy0]
+        lengths = self.starts[column_keys + cy1 + 1] - first
+        total = int(lengths.sum())
+        shift = np.repeat(first - (np.cumsum(lengths) - lengths), lengths)
+        return np.arange(total, dtype=np.int64) + shift
+
+    def bbox(self, xmin, xmax, ymin, ymax):
+        """
+        Get points inside bounding box (inclusive)
+
+        Arguments:
+            xmin, xmax, ymin, ymax  Bounding box in EPSG:3857
+
+        Return:
+            Sorted numpy array of original positions of points
+        """
+        positions = self.candidates(xmin, xmax, ymin, ymax)
+        xs, ys = self.xs[positions], self.ys[positions]
+        inside = (xs >= xmin) & (xs <= xmax) & (ys >= ymin) & (ys <= ymax)
+        return np.sort(self.order[positions[inside]])
+
+    def radius(self, x, y, radius):
+        """
+        Get points at most radius from point
+
+        Arguments:
+            x, y    Center in EPSG:3857
+            radius  Distance in metres
+
+        Return:
+            Sorted numpy array of original positions of points
+        """
+        positions = self.candidates(x - radius, x + radius, y - radius, y + radius)
+        inside = (self.xs[positions] - x) ** 2 + (self.ys[positions] - y) ** 2 <= radius ** 2
+        return np.sort(self.order[positions[inside]])
+
+
+def get_grid_index(df, cell=1000.0):
+    """
+    Get grid index of columns x, y of dataframe, built only once per dataframe
+
+    Index is kept while dataframe exists, dataframe must not be modified
+    in place after index was built.
+
+    Arguments:
+        df      DataFrame with columns x, y in EPSG:3857
+        cell    Size of cell in metres
+
+    Return:
+        GridIndex
+    """
+    key = (id(df), cell)
+    if key in _indexes:
+        reference, index = _indexes[key]
+        if reference() is df:
+            return index
+
+    index = GridIndex.build(df['x'].to_numpy(), df['y'].to_numpy(), cell)
+    _indexes[key] = (weakref.ref(df, lambda _: _indexes.pop(key, None)), index)
+    return index
+
+
+def get_region_index(downloader, region, cell=1000.0):
+    """
+    Get grid index of coordinates in columnar cache of region
+
+    Index is stored in folder of region cache with version of cache (time
+    and size of meta.json) in its name, so it is built once per version of
+    cache and removed together with replaced cache. Positions are rows of
+    region in get_dict without conditions.
+
+    Arguments:
+        downloader  DataDownloader with projected cache (columns x, y)
+        region      Region code
+        cell        Size of cell in metres
+
+    Return:
+        GridIndex
+    """
+    path = downloader.cache_path(region)
+    stat = os.stat(f"{path}/meta.json")
+    name = f"grid_{cell:g}_{stat.st_mtime_ns}_{stat.st_size}.npz"
+    key = (os.path.abspath(path), cell)
+    if key in _region_indexes and _region_indexes[key][0] == name:
+        return _region_indexes[key][1]
+
+    if os.path.exists(f"{path}/{name}"):
+        index = GridIndex.load(f"{path}/{name}")
+    else:
+        index = GridIndex.build(np.load(f"{path}/x.npy", mmap_mode='r'), np.load(f"{path}/y.npy", mmap_mode='r'),
+                                cell)
+        # Indexy starsich verzi cache (po prepocitani x, y) se smazou
+        for old in os.listdir(path):
+            if old.startswith(f"grid_{cell:g}_"):
+                os.remove(f"{path}/{old}")
+        index.save(f"{path}/{name}.tmp.npz")
+        os.replace(f"{path}/{name}.tmp.npz", f"{path}/{name}")
+    _region_indexes[key] = (name, index)
+    return index
+
+
+def crop_regions(downloader, regions, viewport, cell=1000.0):
+    """
+    Get rows of cached regions with coordinates inside viewport
+
+    Arguments:
+        downloader  DataDownloader with projected cache (columns x, y)
+        regions     List of region codes
+        viewport    Tuple (xmin, xmax, ymin, ymax)
+        cell        Size of cell in metres
+
+    Return:
+        Dictionary region : sorted numpy array of rows, see get_region_index
+    """
+    return {region: get_region_index(downloader, region, cell).bbox(*viewport) for region in regions}
+
+
+def crop_rows(df, viewport):
+    """
+    Get positions of rows of dataframe with coordinates inside viewport
+
+    Arguments:
+        df          DataFrame with columns x, y in EPSG:3857
+        viewport    Tuple (xmin, xmax, ymin, ymax)
+
+    Return:
+        Sorted numpy array of positions (for iloc)
+    """
+    return get_grid_index(df).bbox(*viewport)
+
+
+def crop(df, viewport):
+    """
+    Get rows of dataframe with coordinates inside viewport using grid index
+
+    Arguments:
+        df          DataFrame with columns x, y in EPSG:3857
+        viewport    Tuple (xmin, xmax, ymin, ymax)
+
+    Return:
+        DataFrame with rows inside viewport
+    """
+    return df.iloc[crop_rows(df, viewport)]
+
+
+def gaussian_matrix(n, sigma):
+    """
+    Get matrix of 1D Gaussian smoothing, every column sums to 1
+
+    Arguments:
+        n       Number of cells
+        sigma   Standard deviation in cells
+
+    Return:
+        Numpy array n x n, smoothed = matrix @ values
+    """
+    index = np.arange(n)
+    matrix = np.exp(-0.5 * ((index[:, np.newaxis] - index[np.newaxis, :]) / sigma) ** 2)
+    return matrix / matrix.sum(axis=0, keepdims=True)
+
+
+def rasterize(x, y, extent, shape=(256, 256), sigma=0.0):
+    """
+    Count points in cells of raster, optionally smoothed by Gaussian
+
+    Arguments:
+        x, y    Numpy arrays with coordinates in EPSG:3857
+        extent  Tuple (xmin, xmax, ymin, ymax) of raster, zero width or
+                height puts all points to first column or row
+        shape   Tuple (rows, columns) of raster
+        sigma   Standard deviation of smoothing in cells (0 is no smoothing)
+
+    Return:
+        Numpy array rows x columns of float64, first row is north (for imshow
+        with extent)
+    """
+    xmin, xmax, ymin, ymax = extent
+    rows, columns = shape
+    x = np.asarray(x, dtype=np.float64)
+    y = np.asarray(y, dtype=np.float64)
+    inside = (x >= xmin) & (x <= xmax) & (y >= ymin) & (y <= ymax)
+    # Rozsah nulove sirky nebo vysky (jeden bod, body na primce) ma jedno pole
+    width = xmax - xmin if xmax > xmin else np.inf
+    height = ymax - ymin if ymax > ymin else np.inf
+    column = ((x[inside] - xmin) / width * columns).astype(np.int64).clip(0, columns - 1)
+    row = ((ymax - y[inside]) / height * rows).astype(np.int64).clip(0, rows - 1)
+    raster = np.bincount(row * columns + column, minlength=rows * columns).reshape(rows, columns).astype(np.float64)
+
+    if sigma > 0:
+        # Gaussovo jadro je separabilni, rozmazani jsou dve maticova nasobeni
+        raster = gaussian_matrix(rows, sigma) @ raster @ gaussian_matrix(columns, sigma).T
+    return raster
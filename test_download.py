@@ -0,0 +1,143 @@
+#!/usr/bin/env python3
+"""
+Tests of downloading archives against local HTTP server
+Author: Karel Norek, xnorek01
+"""
+# -*- coding: utf-8 -*-
+import hashlib
+import http.server
+import os
+import tempfile
+import threading
+import unittest
+
+from download import DataDownloader
+
+ARCHIVE = bytes(range(256)) * 64
+
+
+class ArchiveHandler(http.server.BaseHTTPRequestHandler):
+    """
+    Server of one archive with ETag, conditional and Range requests
+    """
+    requests = []
+
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):
+        ArchiveHandler.requests.append(dict(self.headers))
+        etag = '"' + hashlib.md5(ARCHIVE).hexdigest() + '"'
+        if self.headers.get('If-None-Match') == etag:
+            self.send_response(304)
+            self.end_headers()
+            return
+
+        start = 0
+        if self.headers.get('Range') is not None and self.headers.get('If-Range') == etag:
+            start = int(self.headers['Range'].split('=')[1].rstrip('-'))
+            if start >= len(ARCHIVE):
+                # Stejne jako bezne servery, rozsah za koncem souboru nelze splnit
+                self.send_response(416)
+                self.send_header('Content-Range', f"bytes */{len(ARCHIVE)}")
+                self.send_header('Content-Length', '0')
+                self.end_headers()
+                return
+            self.send_response(206)
+            self.send_header('Content-Range', f"bytes {start}-{len(ARCHIVE) - 1}/{len(ARCHIVE)}")
+        else:
+            self.send_response(200)
+        self.send_header('ETag', etag)
+        self.send_header('Content-Length', str(len(ARCHIVE) - start))
+        self.end_headers()
+        self.wfile.write(ARCHIVE[start:])
+
+
+class DownloadFileTest(unittest.TestCase):
+    """
+    Resuming of interrupted downloads in DataDownloader.download_file
+    """
+
+    @classmethod
+    def setUpClass(cls):
+        cls.server = http.server.ThreadingHTTPServer(('127.0.0.1', 0), ArchiveHandler)
+        threading.Thread(target=cls.server.serve_forever, daemon=True).start()
+        cls.link = f"http://127.0.0.1:{cls.server.server_address[1]}/data/data2020.zip"
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.server.shutdown()
+        cls.server.server_close()
+
+    def setUp(self):
+        self.cwd = os.getcwd()
+        self.tmp = tempfile.TemporaryDirectory()
+        os.chdir(self.tmp.name)
+        self.downloader = DataDownloader(url=self.link.rsplit('/', 2)[0] + '/')
+        self.manifest = self.downloader.load_manifest()
+        self.lock = threading.Lock()
+        self.path = f"./{self.downloader.folder}/data2020.zip"
+        ArchiveHandler.requests = []
+
+    def tearDown(self):
+        os.chdir(self.cwd)
+        self.tmp.cleanup()
+
+    def download(self):
+        self.downloader.download_file(self.link, self.manifest, self.lock)
+
+    def interrupt(self, size):
+        """
+        Leave part of archive as after download interrupted after size bytes
+        """
+        self.download()
+        os.rename(self.path, self.path + '.part')
+        with open(self.path + '.part', 'r+b') as fp:
+            fp.truncate(size)
+        self.manifest['archives']['data2020.zip'] = {'pending': self.manifest['archives']['data2020.zip']}
+        ArchiveHandler.requests = []
+
+    def check_archive(self):
+        with open(self.path, 'rb') as fp:
+            self.assertEqual(fp.read(), ARCHIVE)
+        self.assertFalse(os.path.exists(self.path + '.part'))
+        self.assertIn('etag', self.manifest['archives']['data2020.zip'])
+        self.assertNotIn('pending', self.manifest['archives']['data2020.zip'])
+
+    def test_download(self):
+        self.download()
+        self.check_archive()
+
+    def test_not_modified(self):
+        self.download()
+        ArchiveHandler.requests = []
+        self.download()
+        self.assertIn('If-None-Match', ArchiveHandler.requests[0])
+        self.check_archive()
+
+    def test_resume(self):
+        self.interrupt(1000)
+        self.download()
+        self.assertEqual(ArchiveHandler.requests[0]['Range'], "bytes=1000-")
+        self.check_archive()
+
+    def test_resume_whole_part(self):
+        self.interrupt(len(ARCHIVE))
+        self.download()
+        self.assertEqual(len(ArchiveHandler.requests), 1)
+        self.check_archive()
+        # Dalsi beh uz posle jen podmineny pozadavek
+        self.download()
+        self.assertIn('If-None-Match', ArchiveHandler.requests[1])
+
+    def test_resume_longer_part(self):
+        self.interrupt(len(ARCHIVE))
+        with open(self.path + '.part', 'ab') as fp:
+            fp.write(b'x')
+        self.download()
+        self.assertNotIn('Range', ArchiveHandler.requests[1])
+        self.check_archive()
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,324 @@
+#!/usr/bin/env python3
+"""
+Local cache of basemap tiles for plots in EPSG:3857
+Author: Karel Norek, xnorek01
+"""
+# -*- coding: utf-8 -*-
+import argparse
+import concurrent.futures
+import io
+import math
+import os
+
+import numpy as np
+import requests
+from PIL import Image
+
+# Polomer a polovina sirky sveta ve Web Mercator (EPSG:3857)
+RADIUS = 6378137.0
+ORIGIN = math.pi * RADIUS
+TILE_SIZE = 256
+
+TONER_LITE = "https://tiles.stadiamaps.com/tiles/stamen_toner_lite/{z}/{x}/{y}.png"
+
+# Ohraniceni Jihomoravskeho kraje (zapad, jih, vychod, sever) ve stupnich
+JHM_BOUNDS = (15.54, 48.55, 17.65, 49.64)
+
+
+def lonlat_to_xy(lon, lat):
+    """
+    Convert longitude and latitude to EPSG:3857
+
+    Arguments:
+        lon, lat    Degrees (numbers or numpy arrays)
+
+    Return:
+        Tuple (x, y) in metres
+    """
+    x = RADIUS * np.radians(lon)
+    y = RADIUS * np.log(np.tan(np.pi / 4 + np.radians(lat) / 2))
+    return x, y
+
+
+def xy_to_lonlat(x, y):
+    """
+    Convert EPSG:3857 to longitude and latitude
+
+    Arguments:
+        x, y        Metres (numbers or numpy arrays)
+
+    Return:
+        Tuple (lon, lat) in degrees
+    """
+    lon = np.degrees(np.asarray(x) / RADIUS)
+    lat = np.degrees(2 * np.arctan(np.exp(np.asarray(y) / RADIUS)) - np.pi / 2)
+    return lon, lat
+
+
+def auto_zoom(extent, max_zoom=18):
+    """
+    Choose zoom for extent the same way as contextily
+
+    Arguments:
+        extent      Tuple (xmin, xmax, ymin, ymax) in EPSG:3857
+        max_zoom    Highest zoom
+
+    Return:
+        Zoom level
+    """
+    (west, east), (south, north) = xy_to_lonlat(extent[:2], extent[2:])
+    lon_length = max(abs(east - west), 1e-9)
+    lat_length = max(abs(north - south), 1e-9)
+    zoom = max(math.ceil(math.log2(360 * 2.0 / lon_length)), math.ceil(math.log2(360 * 2.0 / lat_length)))
+    return int(min(max(zoom, 0), max_zoom))
+
+
+def tile_range(extent, zoom):
+    """
+    Get tiles covering extent
+
+    Arguments:
+        extent      Tuple (xmin, xmax, ymin, ymax) in EPSG:3857
+        zoom        Zoom level
+
+    Return:
+        Tuple (x0, x1, y0, y1) of inclusive tile indices, y from north
+    """
+    n = 1 << zoom
+    size = 2 * ORIGIN / n
+    xmin, xmax = sorted(extent[:2])
+    ymin, ymax = sorted(extent[2:])
+    x0, x1 = (min(max(int((value + ORIGIN) // size), 0), n - 1) for value in (xmin, xmax))
+    y0, y1 = (min(max(int((ORIGIN - value) // size), 0), n - 1) for value in (ymax, ymin))
+    return x0, x1, y0, y1
+
+
+def tile_extent(tiles, zoom):
+    """
+    Get extent of tiles
+
+    Arguments:
+        tiles       Tuple (x0, x1, y0, y1), see tile_range
+        zoom        Zoom level
+
+    Return:
+        Tuple (left, right, bottom, top) in EPSG:3857 for imshow
+    """
+    x0, x1, y0, y1 = tiles
+    size = 2 * ORIGIN / (1 << zoom)
+    return -ORIGIN + x0 * size, -ORIGIN + (x1 + 1) * size, ORIGIN - (y1 + 1) * size, ORIGIN - y0 * size
+
+
+class TileCache:
+    """
+    Tiles stored in folder as {z}/{x}/{y}.png
+
+    Missing tiles are downloaded once from url, in offline mode they are
+    never downloaded and missing tile is an error. Stitched images are
+    kept in memory, so axes with the same extent and zoom share one image.
+
+    Attributes:
+        folder      Folder with tiles
+        url         Template of tile url with {z}, {x}, {y}, file:// urls
+                    are read from local folder (tile stand-in)
+        offline     Do not download tiles
+    """
+
+    folder = "tiles"
+    url = TONER_LITE
+    offline = False
+    fetch_workers = 8
+    headers = {'User-Agent': 'izv-tiles'}
+    shared_images = {}
+
+    def __init__(self, folder=None, url=None, offline=None):
+        """
+        Initialize cache, arguments default to class attributes
+
+        Arguments:
+            folder      Folder with tiles
+            url         Template of tile url
+            offline     Do not download tiles
+        """
+        if folder is not None:
+            self.folder = folder
+        if url is not None:
+            self.url = url
+        if offline is not None:
+            self.offline = offline
+
+    def tile_path(self, x, y, zoom):
+        """
+        Get path of tile in cache
+        """
+        return os.path.join(self.folder, str(zoom), str(x), f"{y}.png")
+
+    def fetch(self, x, y, zoom):
+        """
+        Get tile from cache, download it if it is missing
+
+        Arguments:
+            x, y        Tile indices
+            zoom        Zoom level
+
+        Return:
+            Path to tile
+        """
+        path = self.tile_path(x, y, zoom)
+        if os.path.exists(path):
+            return path
+        if self.offline:
+            raise FileNotFoundError(f"tile {zoom}/{x}/{y} is not in cache {self.folder} (offline)")
+
+        url = self.url.format(z=zoom, x=x, y=y)
+        if url.startswith('file://'):
+            with open(url[len('file://'):], 'rb') as f:
+                content = f.read()
+        else:
+            r = requests.get(url, headers=self.headers, timeout=30)
+            r.raise_for_status()
+            content = r.content
+
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path + '.part', 'wb') as f:
+            f.write(content)
+        os.replace(path + '.part', path)
+        return path
+
+    def fetch_range(self, tiles, zoom):
+        """
+        Get all tiles of range, missing tiles are downloaded in parallel
+
+        Arguments:
+            tiles       Tuple (x0, x1, y0, y1), see tile_range
+            zoom        Zoom level
+
+        Return:
+            Dictionary (x, y) : path
+        """
+        x0, x1, y0, y1 = tiles
+        keys = [(x, y) for x in range(x0, x1 + 1) for y in range(y0, y1 + 1)]
+        with concurrent.futures.ThreadPoolExecutor(self.fetch_workers) as executor:
+            paths = executor.map(lambda key: self.fetch(key[0], key[1], zoom), keys)
+            return dict(zip(keys, paths))
+
+    def image(self, extent, zoom='auto'):
+        """
+        Get stitched image of tiles covering extent
+
+        Arguments:
+            extent      Tuple (xmin, xmax, ymin, ymax) in EPSG:3857
+            zoom        Zoom level or 'auto'
+
+        Return:
+            Tuple (image, extent of image for imshow)
+        """
+        if zoom == 'auto':
+            zoom = auto_zoom(extent)
+        tiles = tile_range(extent, zoom)
+        key = (os.path.abspath(self.folder), self.url, zoom) + tiles
+        if key in self.shared_images:
+            return self.shared_images[key]
+
+        x0, x1, y0, y1 = tiles
+        paths = self.fetch_range(tiles, zoom)
+        image = np.empty(((y1 - y0 + 1) * TILE_SIZE, (x1 - x0 + 1) * TILE_SIZE, 3), dtype=np.uint8)
+        for (x, y), path in paths.items():
+            with Image.open(path) as tile:
+                tile = tile.convert('RGB')
+                if tile.size != (TILE_SIZE, TILE_SIZE):
+                    tile = tile.resize((TILE_SIZE, TILE_SIZE))
+                image[(y - y0) * TILE_SIZE:(y - y0 + 1) * TILE_SIZE,
+                      (x - x0) * TILE_SIZE:(x - x0 + 1) * TILE_SIZE] = np.asarray(tile)
+
+        self.shared_images[key] = (image, tile_extent(tiles, zoom))
+        return self.shared_images[key]
+
+    def seed(self, bounds=JHM_BOUNDS, zooms=range(6, 13)):
+        """
+        Download all tiles of area for offline use
+
+        Arguments:
+            bounds      Tuple (west, south, east, north) in degrees
+            zooms       Zoom levels
+
+        Return:
+            Number of tiles in cache for area
+        """
+        x, y = lonlat_to_xy(np.array(bounds[0::2]), np.array(bounds[1::2]))
+        count = 0
+        for zoom in zooms:
+            count += len(self.fetch_range(tile_range((x[0], x[1], y[0], y[1]), zoom), zoom))
+        return count
+
+
+def add_basemap(ax, tiles=None, zoom='auto', interpolation='bilinear'):
+    """
+    Draw tiles under data of axes in EPSG:3857, replacement of ctx.add_basemap
+
+    Arguments:
+        ax              Matplotlib axes
+        tiles           TileCache (default TileCache())
+        zoom            Zoom level or 'auto'
+        interpolation   Interpolation of image
+    """
+    if tiles is None:
+        tiles = TileCache()
+    xmin, xmax, ymin, ymax = ax.axis()
+    image, extent = tiles.image((xmin, xmax, ymin, ymax), zoom)
+    ax.imshow(image, extent=extent, interpolation=interpolation)
+    ax.axis((xmin, xmax, ymin, ymax))
+
+
+def make_standin(folder, bounds=JHM_BOUNDS, zooms=range(6, 13)):
+    """
+    Create local tile stand-in, plain tiles with grid for offline testing
+
+    Arguments:
+        folder      Folder for tiles ({z}/{x}/{y}.png)
+        bounds      Tuple (west, south, east, north) in degrees
+        zooms       Zoom levels
+
+    Return:
+        Number of created tiles
+    """
+    tile = np.full((TILE_SIZE, TILE_SIZE, 3), 235, dtype=np.uint8)
+    tile[[0, -1], :] = tile[:, [0, -1]] = 200
+    buffer = io.BytesIO()
+    Image.fromarray(tile).save(buffer, format='png')
+
+    x, y = lonlat_to_xy(np.array(bounds[0::2]), np.array(bounds[1::2]))
+    count = 0
+    for zoom in zooms:
+        x0, x1, y0, y1 = tile_range((x[0], x[1], y[0], y[1]), zoom)
+        for tx in range(x0, x1 + 1):
+            os.makedirs(os.path.join(folder, str(zoom), str(tx)), exist_ok=True)
+            for ty in range(y0, y1 + 1):
+                with open(os.path.join(folder, str(zoom), str(tx), f"{ty}.png"), 'wb') as f:
+                    f.write(buffer.getvalue())
+                count += 1
+    return count
+
+
+if __name__ == '__main__':
+    common = argparse.ArgumentParser(add_help=False)
+    common.add_argument('--folder', type=str, default=TileCache.folder)
+    common.add_argument('--bounds', type=float, nargs=4, default=JHM_BOUNDS,
+                        metavar=('WEST', 'SOUTH', 'EAST', 'NORTH'))
+    common.add_argument('--zoom', type=int, nargs='+', default=list(range(6, 13)))
+
+    parser = argparse.ArgumentParser()
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    seed = subparsers.add_parser('seed', parents=[common], help='download tiles of area to cache')
+    seed.add_argument('--url', type=str, default=TileCache.url,
+                      help='tile url template, file:///path/{z}/{x}/{y}.png for local tiles')
+
+    subparsers.add_parser('standin', parents=[common], help='create plain local tiles for offline testing')
+
+    args = parser.parse_args()
+    if args.command == 'seed':
+        count = TileCache(args.folder, args.url).seed(args.bounds, args.zoom)
+    else:
+        count = make_standin(args.folder, args.bounds, args.zoom)
+    print(f"{count} tiles in {args.folder}")